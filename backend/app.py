@@ -3,8 +3,17 @@ from flask import Flask, request, jsonify
 from dotenv import load_dotenv
 from flask_cors import CORS
 from openai import OpenAI
-from firebase_config import verify_firebase_token, get_user_role, create_user_document, db
+from firebase_config import (
+    verify_firebase_token, get_user_role, get_user_context, create_user_document, delete_recursive, db,
+    get_token_cache_stats, get_role_cache_stats, start_role_listener
+)
+from config.assistant_config import PAGINATION_CONFIG
+from utils.pagination import encode_cursor, decode_cursor, get_page_size
+from services.chat_janitor import chat_janitor
+from services.user_threads import start_thread_listener
+from services.chat_history import save_exchange, new_chat_fields, chat_has_messages, last_activity
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 import firebase_admin
 from firebase_admin import firestore
 
@@ -20,6 +29,11 @@ CORS(app, resources={r"/*": {"origins": "*"}})
 # Inicializar OpenAI
 client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
+# Invalidación de la caché de roles ante cambios en `users` (si está habilitada)
+role_listener = start_role_listener()
+# Invalidación de los thread_id cacheados cuando otro worker compacta un thread
+thread_listener = start_thread_listener()
+
 # Middleware para verificar autenticación
 def require_auth(f):
     def decorated_function(*args, **kwargs):
@@ -55,6 +69,10 @@ def home():
 @app.route('/health', methods=['GET'])
 def health_check():
     """Health check para monitoreo"""
+    from services.functions import get_quote_cache_stats, near_duplicates
+    from utils.analysis_cache import analysis_cache
+    from utils.images import get_preprocess_stats
+    
     try:
         # Verificar conexión a Firebase
         db.collection('health').document('test').get()
@@ -68,7 +86,16 @@ def health_check():
             'services': {
                 'firebase': 'connected',
                 'openai': 'connected'
-            }
+            },
+            'caches': {
+                'tokens': get_token_cache_stats(),
+                'roles': get_role_cache_stats(),
+                'quotes': get_quote_cache_stats(),
+                'analyses': analysis_cache.stats(),
+                'near_duplicates': near_duplicates.stats()
+            },
+            'janitor': chat_janitor.stats(),
+            'image_preprocessing': get_preprocess_stats()
         }), 200
     except Exception as e:
         return jsonify({
@@ -83,7 +110,7 @@ def create_chat():
     Crea un nuevo chat vacío
     """
     user_id = request.user['uid']
-    user_role = get_user_role(user_id)
+    user_role = get_user_role(user_id, request.user)
     
     # Verificar si el usuario es premium
     if user_role != 'premium':
@@ -96,13 +123,12 @@ def create_chat():
         
         # Crear el documento del chat con metadata
         chat_ref.set({
-            'created_at': datetime.now(),
-            'user_id': user_id,
+            **new_chat_fields(user_id),
             'message_count': 0
         })
 
-        # Limitar a últimos 5 chats
-        limit_chats(user_id)
+        # Limitar a últimos 5 chats (en segundo plano)
+        chat_janitor.mark_dirty(user_id)
 
         return jsonify({
             'chat_id': chat_id,
@@ -124,14 +150,14 @@ def chat():
         return jsonify({'error': 'Mensaje requerido'}), 400
 
     user_id = request.user['uid']
-    user_role = get_user_role(user_id)
+    user_role = get_user_role(user_id, request.user)
     
     # Verificar si el usuario es premium
     if user_role != 'premium':
         return jsonify({'error': 'Se requiere cuenta premium para chatear'}), 403
 
     try:
-        # Si no hay chat_id, crear un nuevo chat
+        # Si no hay chat_id, crear un nuevo chat (se persiste junto con el intercambio)
         if not chat_id:
             chat_ref = db.collection('chats').document(user_id).collection('conversations').document()
             chat_id = chat_ref.id
@@ -141,71 +167,25 @@ def chat():
             if not chat_ref.get().exists:
                 return jsonify({'error': 'Chat no encontrado'}), 404
 
-        # Guardar mensaje del usuario
-        message_data = {
-            'sender': 'user',
-            'text': user_message,
-            'timestamp': datetime.now()
-        }
-        chat_ref.collection('messages').add(message_data)
-
-                        # Usar el nuevo sistema de Assistants API
-        from services.openai_assistant import assistant_manager
-        
-        # Obtener o crear thread_id para el usuario
-        def get_user_thread_id(user_id):
-            try:
-                # Buscar en Firestore si el usuario ya tiene un thread_id
-                user_doc = db.collection('users').document(user_id).get()
-                
-                if user_doc.exists:
-                    user_data = user_doc.to_dict()
-                    thread_id = user_data.get('thread_id')
-                    
-                    if thread_id:
-                        # Verificar que el thread aún existe en OpenAI
-                        try:
-                            assistant_manager.client.beta.threads.retrieve(thread_id)
-                            return thread_id
-                        except Exception as e:
-                            print(f"Thread {thread_id} no existe, creando uno nuevo")
-                
-                # Crear nuevo thread
-                thread_id = assistant_manager.get_or_create_thread(user_id)
-                
-                # Guardar thread_id en Firestore
-                db.collection('users').document(user_id).update({
-                    'thread_id': thread_id,
-                    'fechaActualizacion': datetime.now()
-                })
-                
-                return thread_id
-                
-            except Exception as e:
-                print(f"Error obteniendo thread_id para usuario {user_id}: {e}")
-                # Fallback: crear thread sin guardar en Firebase
-                return assistant_manager.get_or_create_thread(user_id)
-        
-        thread_id = get_user_thread_id(user_id)
+        received_at = datetime.now()
+
+        # Usar el nuevo sistema de Assistants API
+        from services.user_threads import send_user_message
         
-        # Enviar mensaje al assistant
-        result = assistant_manager.send_message(thread_id, user_message)
+        # Enviar mensaje al thread del usuario (se recrea solo si ya no existe)
+        result = send_user_message(user_id, user_message)
         
         if result['success']:
             bot_reply = result['message']
         else:
             bot_reply = f"Error procesando mensaje: {result['error']}"
 
-        # Guardar respuesta del bot
-        bot_message_data = {
-            'sender': 'bot',
-            'text': bot_reply,
-            'timestamp': datetime.now()
-        }
-        chat_ref.collection('messages').add(bot_message_data)
+        # Guardar mensaje del usuario, respuesta del bot y contadores del chat
+        save_exchange(chat_ref, user_id, user_message, bot_reply,
+                      user_timestamp=received_at, assistant_sender='bot')
 
-        # Limitar a últimos 5 chats
-        limit_chats(user_id)
+        # Limitar a últimos 5 chats (en segundo plano)
+        chat_janitor.mark_dirty(user_id)
 
         return jsonify({
             'chat_id': chat_id, 
@@ -224,71 +204,75 @@ def history():
     print(f"🔍 Obteniendo historial para usuario: {user_id}")
     
     try:
-        # Obtener todos los chats del usuario
+        page_size = get_page_size(
+            request.args,
+            PAGINATION_CONFIG["history_default_page_size"],
+            PAGINATION_CONFIG["history_max_page_size"]
+        )
+        try:
+            cursor = decode_cursor(request.args.get('cursor'))
+        except ValueError:
+            return jsonify({'error': 'Cursor inválido'}), 400
+        
+        # Solo una página de chats, ordenada por última actividad y limitada en Firestore
+        # (los chats anteriores a `last_message` se completan con backfill_last_message.py)
         chats_ref = db.collection('chats').document(user_id).collection('conversations')
+        query = chats_ref.order_by('last_message', direction=firestore.Query.DESCENDING)
         
-        # Obtener todos los chats sin ordenar primero
-        all_chats = list(chats_ref.stream())
-        print(f"📊 Total de chats encontrados: {len(all_chats)}")
+        if cursor:
+            last_chat = chats_ref.document(str(cursor.get('chat_id', ''))).get()
+            if not last_chat.exists:
+                return jsonify({'error': 'Cursor inválido'}), 400
+            query = query.start_after(last_chat)
         
-        resultado = []
-        for chat in all_chats:
-            try:
-                chat_data = chat.to_dict()
-                print(f"📝 Procesando chat {chat.id}: {chat_data}")
-                
-                # Obtener mensajes del chat
-                messages_ref = chat.reference.collection('messages')
-                messages = list(messages_ref.stream())
-                
-                mensajes = []
-                for msg in messages:
-                    msg_data = msg.to_dict()
-                    mensajes.append({
-                        'id': msg.id,
-                        'sender': msg_data['sender'],
-                        'text': msg_data['text'],
-                        'timestamp': msg_data['timestamp'].isoformat() if msg_data['timestamp'] else None
-                    })
-                
-                # Determinar la fecha de creación
-                created_at = chat_data.get('created_at')
-                if not created_at:
-                    created_at = chat_data.get('timestamp', datetime.now())
-                
-                # Asegurar que created_at sea un datetime
-                if not isinstance(created_at, datetime):
-                    created_at = datetime.now()
-                
-                # Incluir el chat si tiene mensajes o es reciente
-                # Convertir created_at a datetime naive si es necesario
-                if hasattr(created_at, 'replace'):
-                    created_at_naive = created_at.replace(tzinfo=None)
-                else:
-                    created_at_naive = created_at
-                
-                is_recent = (datetime.now() - created_at_naive).total_seconds() < 3600
-                print(f"📅 Chat {chat.id}: created_at={created_at_naive}, is_recent={is_recent}, mensajes={len(mensajes)}")
-                
-                if mensajes or is_recent:
-                    resultado.append({
-                        'chat_id': chat.id,
-                        'created_at': created_at.isoformat(),
-                        'mensajes': mensajes,
-                        'message_count': len(mensajes)
-                    })
-                    print(f"✅ Chat {chat.id} agregado con {len(mensajes)} mensajes")
-                
-            except Exception as chat_error:
-                print(f"❌ Error procesando chat {chat.id}: {chat_error}")
+        # Pedir uno extra para saber si hay más páginas
+        chats = list(query.limit(page_size + 1).stream())
+        has_more = len(chats) > page_size
+        chats = chats[:page_size]
+        
+        # Con los contadores de cada chat se descartan los vacíos sin leer sus mensajes
+        seleccionados = []
+        for chat in chats:
+            chat_data = chat.to_dict()
+            has_messages = chat_has_messages(chat_data)
+            activity = last_activity(chat_data) or datetime.now()
+            is_recent = (datetime.now() - activity).total_seconds() < 3600
+            
+            # Incluir el chat si tiene mensajes o es reciente
+            if has_messages is False and not is_recent:
                 continue
+            seleccionados.append((chat, chat_data, has_messages, is_recent))
         
-        # Ordenar por fecha de creación (más reciente primero)
-        resultado.sort(key=lambda x: x['created_at'], reverse=True)
-        resultado = resultado[:5]  # Limitar a 5 chats
+        # Leer en paralelo los mensajes de los chats que pueden tenerlos
+        to_load = [chat for chat, _, has_messages, _ in seleccionados if has_messages is not False]
+        with ThreadPoolExecutor(max_workers=max(len(to_load), 1)) as executor:
+            mensajes_por_chat = dict(zip([chat.id for chat in to_load], executor.map(load_chat_messages, to_load)))
+        
+        resultado = []
+        for chat, chat_data, has_messages, is_recent in seleccionados:
+            mensajes = mensajes_por_chat.get(chat.id, [])
+            if mensajes is None:
+                continue
+            
+            created_at = chat_data.get('created_at')
+            
+            # Asegurar que created_at sea un datetime
+            if not isinstance(created_at, datetime):
+                created_at = datetime.now()
+            
+            if mensajes or is_recent:
+                resultado.append({
+                    'chat_id': chat.id,
+                    'created_at': created_at.isoformat(),
+                    'mensajes': mensajes,
+                    'message_count': len(mensajes)
+                })
         
         print(f"✅ Historial obtenido: {len(resultado)} chats")
-        return jsonify({'chats': resultado}), 200
+        return jsonify({
+            'chats': resultado,
+            'next_cursor': encode_cursor({'chat_id': chats[-1].id}) if has_more else None
+        }), 200
         
     except Exception as e:
         print(f"❌ Error obteniendo historial: {e}")
@@ -296,23 +280,35 @@ def history():
         traceback.print_exc()
         return jsonify({'error': f'Error obteniendo historial: {str(e)}'}), 500
 
+def load_chat_messages(chat):
+    """Lee los mensajes de un chat en orden cronológico (None si falla)"""
+    try:
+        messages = chat.reference.collection('messages').order_by('timestamp').stream()
+        
+        mensajes = []
+        for msg in messages:
+            msg_data = msg.to_dict()
+            mensajes.append({
+                'id': msg.id,
+                'sender': msg_data['sender'],
+                'text': msg_data['text'],
+                'timestamp': msg_data['timestamp'].isoformat() if msg_data['timestamp'] else None
+            })
+        return mensajes
+    except Exception as chat_error:
+        print(f"❌ Error procesando chat {chat.id}: {chat_error}")
+        return None
+
 @app.route('/delete_history', methods=['POST'])
 @require_auth
 def delete_history():
     user_id = request.user['uid']
     
     try:
-        # Eliminar todos los chats del usuario
+        # Eliminar todos los chats del usuario (con sus mensajes)
         chats_ref = db.collection('chats').document(user_id).collection('conversations')
-        chats = chats_ref.stream()
-        
-        for chat in chats:
-            # Eliminar todos los mensajes del chat
-            messages = chat.reference.collection('messages').stream()
-            for msg in messages:
-                msg.reference.delete()
-            # Eliminar el chat
-            chat.reference.delete()
+        deleted = delete_recursive(chats_ref)
+        print(f"Historial eliminado para {user_id}: {deleted} documentos")
         
         return jsonify({'message': 'Historial eliminado'}), 200
         
@@ -337,13 +333,8 @@ def delete_chat():
         if not chat_ref.get().exists:
             return jsonify({'error': 'Chat no encontrado'}), 404
 
-        # Eliminar todos los mensajes del chat
-        messages = chat_ref.collection('messages').stream()
-        for msg in messages:
-            msg.reference.delete()
-        
-        # Eliminar el chat
-        chat_ref.delete()
+        # Eliminar el chat junto con sus mensajes
+        delete_recursive(chat_ref)
         
         return jsonify({'success': True}), 200
         
@@ -355,7 +346,7 @@ def delete_chat():
 @require_auth
 def get_user_role_endpoint():
     user_id = request.user['uid']
-    role = get_user_role(user_id)
+    role = get_user_role(user_id, request.user)
     return jsonify({'role': role}), 200
 
 @app.route('/user/profile', methods=['GET'])
@@ -364,21 +355,12 @@ def get_user_profile():
     """Obtener el perfil completo del usuario"""
     try:
         user_id = request.user['uid']
-        user_doc = db.collection('users').document(user_id).get()
+        user_context = get_user_context(user_id)
         
-        if not user_doc.exists:
+        if not user_context.exists:
             return jsonify({'error': 'Usuario no encontrado'}), 404
         
-        user_data = user_doc.to_dict()
-        return jsonify({
-            'nombre': user_data.get('nombre', ''),
-            'apellido': user_data.get('apellido', ''),
-            'pais': user_data.get('pais', ''),
-            'email': user_data.get('email', ''),
-            'rol': user_data.get('rol', 'free'),
-            'fechaCreacion': user_data.get('fechaCreacion', ''),
-            'fechaActualizacion': user_data.get('fechaActualizacion', '')
-        }), 200
+        return jsonify(user_context.profile), 200
         
     except Exception as e:
         print(f"Error obteniendo perfil: {e}")
@@ -435,7 +417,7 @@ def analyze_chart():
         return jsonify({'error': 'URL de imagen requerida'}), 400
 
     user_id = request.user['uid']
-    user_role = get_user_role(user_id)
+    user_role = get_user_role(user_id, request.user)
     
     # Verificar si el usuario es premium
     if user_role != 'premium':
@@ -569,66 +551,6 @@ def test_firestore():
             'error': str(e)
         }), 500
 
-def limit_chats(user_id):
-    """Limita a 5 chats por usuario, eliminando los más antiguos"""
-    try:
-        chats_ref = db.collection('chats').document(user_id).collection('conversations')
-        
-        # Intentar ordenar por created_at, si falla usar timestamp
-        try:
-            chats = chats_ref.order_by('created_at', direction=firestore.Query.DESCENDING).stream()
-        except:
-            # Fallback para chats antiguos
-            chats = chats_ref.order_by('timestamp', direction=firestore.Query.DESCENDING).stream()
-        
-        chat_list = list(chats)
-        if len(chat_list) > 5:
-            # Eliminar chats más antiguos
-            for chat in chat_list[5:]:
-                # Eliminar mensajes
-                messages = chat.reference.collection('messages').stream()
-                for msg in messages:
-                    msg.reference.delete()
-                # Eliminar chat
-                chat.reference.delete()
-        
-        # Limpiar chats vacíos antiguos (más de 1 hora sin mensajes)
-        clean_empty_chats(user_id)
-    except Exception as e:
-        print(f"Error limitando chats: {e}")
-
-def clean_empty_chats(user_id):
-    """Elimina chats vacíos que tienen más de 1 hora sin mensajes"""
-    try:
-        chats_ref = db.collection('chats').document(user_id).collection('conversations')
-        chats = chats_ref.stream()
-        
-        for chat in chats:
-            chat_data = chat.to_dict()
-            created_at = chat_data.get('created_at', datetime.now())
-            
-            # Asegurar que created_at sea un datetime
-            if not isinstance(created_at, datetime):
-                created_at = datetime.now()
-            
-            # Verificar si el chat tiene mensajes
-            messages = chat.reference.collection('messages').limit(1).stream()
-            has_messages = len(list(messages)) > 0
-            
-            # Si no tiene mensajes y es más antiguo que 1 hora, eliminarlo
-            # Convertir created_at a datetime naive si es necesario
-            if hasattr(created_at, 'replace'):
-                created_at_naive = created_at.replace(tzinfo=None)
-            else:
-                created_at_naive = created_at
-                
-            if not has_messages and (datetime.now() - created_at_naive).total_seconds() > 3600:
-                chat.reference.delete()
-                print(f"Chat vacío eliminado: {chat.id}")
-                
-    except Exception as e:
-        print(f"Error limpiando chats vacíos: {e}")
-
 # Registrar blueprints
 from routes.chat import init_app as init_chat_routes
 init_chat_routes(app)
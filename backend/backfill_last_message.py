@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+"""
+Completa `last_message` en las conversaciones creadas antes de ese campo.
+`/history` ordena por `last_message` y Firestore omite los documentos que
+no lo tienen. El janitor también lo completa, pero solo para los usuarios
+que vuelven a chatear.
+
+Uso:
+    python backfill_last_message.py
+"""
+
+from dotenv import load_dotenv
+
+# Cargar variables de entorno
+load_dotenv()
+
+def main():
+    from firebase_config import db
+    from services.chat_history import backfill_last_message
+
+    print("🔄 Completando last_message en las conversaciones...")
+    updated = 0
+    for user_chats in db.collection('chats').list_documents():
+        updated += backfill_last_message(list(user_chats.collection('conversations').stream()))
+    print(f"✅ Conversaciones actualizadas: {updated}")
+
+if __name__ == "__main__":
+    main()
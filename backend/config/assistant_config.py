@@ -15,14 +15,34 @@ ASSISTANT_CONFIG = {
 THREAD_CONFIG = {
     "max_messages_per_thread": 50,
     "thread_timeout_seconds": 60,
-    "cleanup_old_threads_days": 30
+    "cleanup_old_threads_days": 30,
+    "thread_cache_ttl_seconds": 600,  # Caché uid -> thread_id en memoria
+    "thread_cache_max_entries": 10000,
+    # Compactación: al superar max_messages_per_thread se resume lo viejo en un thread nuevo
+    "compaction_enabled": True,
+    "compaction_keep_messages": 10,  # Últimos mensajes que se copian tal cual
+    "compaction_max_messages": 300,  # Máximo de mensajes que se leen para el resumen
+    "compaction_summary_model": "gpt-4o-mini",
+    "compaction_summary_max_tokens": 800,
+    # Listener sobre `thread_changes`: cuando un worker compacta un thread, los
+    # demás descartan el thread_id cacheado del usuario en lugar de seguir
+    # enviando al thread reemplazado hasta que venza thread_cache_ttl_seconds
+    "use_snapshot_listener": True
 }
 
 # Configuración de archivos
 FILE_CONFIG = {
     "max_file_size_mb": 10,
     "allowed_extensions": ["png", "jpg", "jpeg", "gif", "webp"],
-    "max_files_per_message": 5
+    "max_files_per_message": 5,
+    # Las subidas se reciben en memoria hasta este tamaño (luego van a disco)
+    "spool_max_memory_mb": 10,
+    # Deduplicación por sha256 (registro en users/{uid}/files): una imagen ya
+    # subida reutiliza su file_id. El TTL debe ser menor o igual a lo que se
+    # conservan los archivos en OpenAI.
+    "dedup_enabled": True,
+    "dedup_global": False,  # Compartir file_id entre usuarios con el mismo contenido
+    "dedup_ttl_hours": 24
 }
 
 # Configuración de rate limiting
@@ -45,12 +65,16 @@ EXTERNAL_APIS = {
     "coingecko": {
         "base_url": "https://api.coingecko.com/api/v3",
         "timeout": 10,
-        "rate_limit_per_minute": 50
+        "rate_limit_per_minute": 50,
+        "cache_ttl_seconds": 30,  # Cotización fresca
+        "stale_ttl_seconds": 120  # Se sirve vieja mientras se refresca en segundo plano
     },
     "exchangerate": {
         "base_url": "https://api.exchangerate-api.com/v4",
         "timeout": 10,
-        "rate_limit_per_minute": 100
+        "rate_limit_per_minute": 100,
+        "cache_ttl_seconds": 300,
+        "stale_ttl_seconds": 1800
     }
 }
 
@@ -59,13 +83,62 @@ IMAGE_ANALYSIS_CONFIG = {
     "max_tokens": 2000,
     "temperature": 0.3,
     "analysis_types": ["technical", "pattern", "support_resistance", "complete"],
-    "default_analysis_type": "complete"
+    "default_analysis_type": "complete",
+    # Caché de resultados por imagen + tipo de análisis + versión de prompt
+    "prompt_version": 1,  # Incrementar al cambiar los prompts de análisis
+    "cache_enabled": True,
+    "cache_ttl_seconds": 3600,
+    "cache_max_entries": 512,
+    "cache_dir": None,  # Directorio para el nivel en disco (None = solo memoria)
+    "cache_disk_max_entries": 5000,
+    # Reutilizar análisis de imágenes casi iguales (dHash, requiere NumPy y Pillow).
+    # Apagado hasta calibrar el umbral con capturas reales: el hash no ve el par ni
+    # la temporalidad, y con 64 bits gráficos distintos quedaban a 3-6 bits
+    "near_duplicate_enabled": False,
+    "near_duplicate_hash_size": 16,  # Hash de 16x16 = 256 bits
+    "near_duplicate_max_distance": 10,  # Bits distintos tolerados (de 256)
+    "near_duplicate_ttl_seconds": 900,  # Solo análisis recientes: el gráfico cambia
+    "near_duplicate_max_entries": 2048
+}
+
+# Preprocesamiento de imágenes antes de enviarlas al modelo de visión (requiere Pillow)
+IMAGE_PREPROCESS_CONFIG = {
+    "enabled": True,
+    "crop_borders": True,  # Recortar márgenes de color uniforme
+    "border_tolerance": 8,
+    # Lado máximo tras reducir. OpenAI lleva el lado menor a 768 y cobra por
+    # tile de 512: un 16:9 a 1024px usa 4 tiles en vez de 6
+    "max_edge_px": 1024,
+    "format": "JPEG",  # JPEG o WEBP
+    "quality": 85,
+    "low_detail_max_px": 512,  # Hasta este tamaño alcanza con detail "low"
+    # Descargar URLs remotas para preprocesarlas. Apagado por defecto: la URL
+    # la elige el usuario. Encendido solo se aceptan hosts con IP pública
+    # (también en cada redirección)
+    "fetch_remote": False,
+    "fetch_timeout": 10,
+    "fetch_max_redirects": 3
+}
+
+# Presupuesto de tokens para get_gpt_response (services/chat.py)
+CONTEXT_BUDGET_CONFIG = {
+    "models": {
+        # context_window: límite del modelo; max_input_tokens: tope propio para el prompt
+        "gpt-4o": {"context_window": 128000, "max_input_tokens": 16000},
+        "gpt-4o-mini": {"context_window": 128000, "max_input_tokens": 12000},
+        "gpt-4-turbo": {"context_window": 128000, "max_input_tokens": 16000}
+    },
+    "default_model_budget": {"context_window": 8192, "max_input_tokens": 6000},
+    "max_response_tokens": 4000,
+    "min_response_tokens": 512,
+    "max_history_message_tokens": 1500  # Mensajes del historial más largos se recortan
 }
 
 # Configuración de funciones disponibles
 AVAILABLE_FUNCTIONS = [
     "get_crypto_price",
     "get_forex_price", 
+    "get_prices",
     "analyze_image",
     "get_market_sentiment",
     "get_economic_calendar"
@@ -104,7 +177,12 @@ TIMEOUTS = {
 RETRY_CONFIG = {
     "max_retries": 3,
     "retry_delay_seconds": 1,
-    "backoff_multiplier": 2
+    "backoff_multiplier": 2,
+    # Plazo total de una llamada con sus reintentos. Debe quedar por debajo de
+    # TOOL_EXECUTION_CONFIG["default_timeout_seconds"] para que la función no
+    # siga reintentando después de que el assistant ya recibió el timeout
+    "total_deadline_seconds": 12,
+    "min_attempt_seconds": 1  # No reintentar si queda menos que esto para el intento
 }
 
 # Configuración de seguridad
@@ -113,4 +191,72 @@ SECURITY_CONFIG = {
     "max_concurrent_requests": 5,
     "require_authentication": True,
     "require_premium": True
-} 
\ No newline at end of file
+}
+
+# Configuración de autenticación
+AUTH_CONFIG = {
+    "token_cache_max_entries": 5000,  # Tokens decodificados en memoria por proceso
+    "clock_skew_seconds": 10  # Tolerancia de reloj al verificar tokens (máximo 60)
+}
+
+# Caché de roles (uid -> rol) compartida entre requests
+ROLE_CACHE_CONFIG = {
+    "ttl_seconds": 300,
+    "max_entries": 10000,
+    # Listener sobre `role_changes` (solo cambios nuevos hechos con set_user_role)
+    # para invalidar al instante en todos los workers. Cambios de rol hechos a
+    # mano en Firestore se ven recién al vencer ttl_seconds.
+    "use_snapshot_listener": True
+}
+
+# Rol como custom claim de Firebase (autorización sin leer Firestore)
+ROLE_CLAIMS_CONFIG = {
+    # Si está activo, el rol se toma del token verificado cuando trae el claim
+    "enabled": False,
+    "claim_name": "rol"
+}
+
+# Configuración de jobs asíncronos del assistant (/api/assistant/chat/jobs)
+JOB_CONFIG = {
+    "max_workers": 8,  # Runs ejecutándose en paralelo por proceso
+    "max_pending_jobs": 100,  # Jobs en cola o ejecutándose antes de rechazar nuevos
+    "max_wait_seconds": 25,  # Máximo long-poll del endpoint de estado
+    "result_ttl_seconds": 600  # Tiempo que se conserva un job terminado
+}
+
+# Ejecución de tool calls pedidas por el assistant
+TOOL_EXECUTION_CONFIG = {
+    "max_workers": 8,  # Funciones ejecutándose en paralelo por proceso
+    "default_timeout_seconds": 15,  # Plazo por llamada
+    "timeouts": {
+        "analyze_image": 45
+    }
+}
+
+# Pool de conexiones HTTP para APIs externas (keep-alive)
+HTTP_POOL_CONFIG = {
+    "pool_connections": 10,  # Hosts distintos con pool propio
+    "pool_maxsize": 20,  # Conexiones reutilizables por host
+    "retry_status_codes": [429, 500, 502, 503, 504],
+    "max_retry_after_seconds": 10  # Tope al header Retry-After de un 429
+}
+
+# Paginación de historiales (page_size por defecto y máximo)
+PAGINATION_CONFIG = {
+    "history_default_page_size": 5,  # Chats por página en /history
+    "history_max_page_size": 20,
+    "assistant_history_default_page_size": 50,  # Mensajes por página en /api/assistant/history
+    "assistant_history_max_page_size": 100
+}
+
+# Limpieza de chats en segundo plano (limit_chats / clean_empty_chats)
+JANITOR_CONFIG = {
+    "interval_seconds": 300,  # Cada usuario se procesa como máximo una vez por intervalo
+    "max_workers": 2,
+    "max_tracked_users": 10000
+}
+
+# Historial de chats en Firestore
+CHAT_HISTORY_CONFIG = {
+    "preview_length": 120  # Caracteres del último mensaje guardados en la conversación
+}
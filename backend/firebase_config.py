@@ -1,7 +1,13 @@
 import os
+import time
+import hashlib
+from datetime import datetime, timedelta, timezone
 import firebase_admin
 from firebase_admin import credentials, auth, firestore
+from flask import g, has_request_context
 from dotenv import load_dotenv
+from config.assistant_config import AUTH_CONFIG, ROLE_CACHE_CONFIG, ROLE_CLAIMS_CONFIG
+from utils.cache import TTLCache
 
 load_dotenv()
 
@@ -34,45 +40,269 @@ except ValueError:
 # Obtener instancia de Firestore
 db = firestore.client()
 
+# Caché de tokens ya verificados (clave: hash del token, expira con el `exp` del token)
+_token_cache = TTLCache(max_entries=AUTH_CONFIG["token_cache_max_entries"])
+
+# Caché de roles entre requests (uid -> rol)
+_role_cache = TTLCache(
+    max_entries=ROLE_CACHE_CONFIG["max_entries"],
+    default_ttl=ROLE_CACHE_CONFIG["ttl_seconds"]
+)
+
+def _token_cache_key(id_token):
+    """Clave de caché: hash del token para no guardar el token en claro"""
+    return hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+
+# Registro de cambios de rol (uno por set_user_role) para invalidar cachés
+ROLE_CHANGES_COLLECTION = 'role_changes'
+
 def verify_firebase_token(id_token):
     """Verifica el token de Firebase y retorna el usuario"""
+    cache_key = _token_cache_key(id_token)
+    decoded_token = _token_cache.get(cache_key)
+    if decoded_token is not None:
+        return decoded_token
+
     try:
         print(f"🔍 Verificando token: {id_token[:20]}...")
-        # Agregar tolerancia de tiempo para manejar desincronización del reloj
-        decoded_token = auth.verify_id_token(id_token, check_revoked=False)
+        # La tolerancia de reloj evita rechazar tokens recién emitidos ("used too early")
+        decoded_token = auth.verify_id_token(
+            id_token,
+            check_revoked=False,
+            clock_skew_seconds=AUTH_CONFIG["clock_skew_seconds"]
+        )
         print(f"✅ Token válido para: {decoded_token.get('email', 'N/A')}")
-        return decoded_token
     except Exception as e:
         print(f"❌ Error verificando token: {e}")
-        # Si es error de tiempo, intentar con tolerancia
-        if "used too early" in str(e) or "clock" in str(e).lower():
-            try:
-                print("🕐 Intentando con tolerancia de tiempo...")
-                import time
-                # Esperar un momento y reintentar
-                time.sleep(2)
-                decoded_token = auth.verify_id_token(id_token, check_revoked=False)
-                print(f"✅ Token válido (con tolerancia): {decoded_token.get('email', 'N/A')}")
-                return decoded_token
-            except Exception as e2:
-                print(f"❌ Error incluso con tolerancia: {e2}")
         return None
 
-def get_user_role(uid):
-    """Obtiene el rol del usuario desde Firestore"""
+    # Cachear hasta la expiración del token (claim `exp`)
+    expires_at = decoded_token.get('exp')
+    if expires_at and expires_at > time.time():
+        _token_cache.set(cache_key, decoded_token, expires_at=expires_at)
+    return decoded_token
+
+def get_token_cache_stats():
+    """Estadísticas de la caché de tokens verificados"""
+    return _token_cache.stats()
+
+class UserContext:
+    """
+    Documento `users/{uid}` leído una sola vez por request.
+
+    Expone rol, thread_id y perfil a todos los que lo necesiten durante
+    el request, evitando lecturas repetidas a Firestore.
+    """
+
+    PROFILE_FIELDS = ('nombre', 'apellido', 'pais', 'email', 'rol', 'fechaCreacion', 'fechaActualizacion')
+
+    def __init__(self, uid, data=None):
+        self.uid = uid
+        self.exists = data is not None
+        self.data = data or {}
+
+    @property
+    def role(self):
+        return self.data.get('rol', 'free')
+
+    @property
+    def thread_id(self):
+        return self.data.get('thread_id')
+
+    @property
+    def profile(self):
+        defaults = {'rol': 'free'}
+        return {field: self.data.get(field, defaults.get(field, '')) for field in self.PROFILE_FIELDS}
+
+    def update(self, fields):
+        """Mantiene la copia local en sincronía después de escribir en Firestore"""
+        self.data.update(fields)
+
+def get_user_context(uid):
+    """
+    Retorna el UserContext del usuario, leyendo Firestore solo la primera
+    vez dentro del request actual. Fuera de un request siempre lee.
+    Los errores de Firestore se propagan y no se cachean.
+    """
+    if has_request_context():
+        contexts = g.setdefault('user_contexts', {})
+        if uid in contexts:
+            return contexts[uid]
+
+    user_doc = db.collection('users').document(uid).get()
+    context = UserContext(uid, user_doc.to_dict() if user_doc.exists else None)
+
+    if has_request_context():
+        g.user_contexts[uid] = context
+    # Aprovechar la lectura para refrescar la caché de roles
+    _role_cache.set(uid, context.role)
+    return context
+
+def update_cached_user_context(uid, fields):
+    """
+    Refleja una escritura en el UserContext ya leído en este request.
+    Fuera de un request (o si no se leyó) no hay copia que actualizar.
+    """
+    if has_request_context():
+        context = g.get('user_contexts', {}).get(uid)
+        if context is not None:
+            context.update(fields)
+
+def get_role_from_claims(decoded_token):
+    """Retorna el rol del custom claim del token, o None si no está disponible"""
+    if not ROLE_CLAIMS_CONFIG["enabled"] or not decoded_token:
+        return None
+    return decoded_token.get(ROLE_CLAIMS_CONFIG["claim_name"])
+
+def get_user_role(uid, decoded_token=None):
+    """
+    Obtiene el rol del usuario. Si se pasa el token verificado y los claims
+    de rol están habilitados, no hace ninguna lectura; si no, usa la caché
+    en memoria y, como último recurso, Firestore.
+    """
+    role = get_role_from_claims(decoded_token)
+    if role:
+        return role
+
+    role = _role_cache.get(uid)
+    if role is not None:
+        return role
+
     try:
         print(f"🔍 Obteniendo rol para usuario: {uid}")
-        user_doc = db.collection('users').document(uid).get()
-        if user_doc.exists:
-            role = user_doc.to_dict().get('rol', 'free')
-            print(f"✅ Rol encontrado: {role}")
-            return role
+        context = get_user_context(uid)
+        if context.exists:
+            print(f"✅ Rol encontrado: {context.role}")
+            return context.role
         print(f"⚠️ Usuario no encontrado, rol por defecto: free")
         return 'free'
     except Exception as e:
         print(f"❌ Error obteniendo rol: {e}")
         return 'free'
 
+def invalidate_user_role(uid):
+    """Descarta el rol cacheado; llamar siempre que cambie `users/{uid}.rol`"""
+    _role_cache.invalidate(uid)
+
+def get_role_cache_stats():
+    """Estadísticas de la caché de roles"""
+    return _role_cache.stats()
+
+def set_user_role(uid, role):
+    """
+    Cambia el rol del usuario. Además de `users/{uid}.rol` registra el
+    cambio en `role_changes`, que escuchan todos los workers (ver
+    start_role_listener) para invalidar su caché al instante.
+    """
+    now = datetime.now(timezone.utc)
+    batch = db.batch()
+    batch.update(db.collection('users').document(uid), {
+        'rol': role,
+        'fechaActualizacion': now
+    })
+    batch.set(db.collection(ROLE_CHANGES_COLLECTION).document(), {
+        'uid': uid,
+        'rol': role,
+        'changed_at': now,
+        # Campo para una política TTL de Firestore sobre la colección
+        'expires_at': now + timedelta(days=1)
+    })
+    batch.commit()
+
+    invalidate_user_role(uid)
+    update_cached_user_context(uid, {'rol': role})
+    if ROLE_CLAIMS_CONFIG["enabled"]:
+        sync_role_claim(uid, role)
+    print(f"✅ Rol de {uid} actualizado a {role}")
+
+def start_role_listener():
+    """
+    Inicia un listener sobre los cambios de rol registrados desde ahora en
+    `role_changes` e invalida la caché de roles de cada usuario afectado.
+    El snapshot inicial está vacío, así que es barato en cada worker.
+    Retorna el watch (o None si está desactivado en ROLE_CACHE_CONFIG).
+    """
+    if not ROLE_CACHE_CONFIG["use_snapshot_listener"]:
+        return None
+
+    def on_role_changes(col_snapshot, changes, read_time):
+        for change in changes:
+            if change.type.name == 'ADDED':
+                _role_cache.invalidate((change.document.to_dict() or {}).get('uid'))
+
+    try:
+        started_at = datetime.now(timezone.utc)
+        watch = (
+            db.collection(ROLE_CHANGES_COLLECTION)
+            .where('changed_at', '>', started_at)
+            .on_snapshot(on_role_changes)
+        )
+        print("✅ Listener de roles iniciado")
+        return watch
+    except Exception as e:
+        print(f"❌ Error iniciando listener de roles: {e}")
+        return None
+
+def sync_role_claim(uid, role=None):
+    """
+    Copia `users/{uid}.rol` al custom claim del usuario en Firebase Auth.
+    Conserva los demás claims y solo escribe si el valor cambió.
+    El nuevo claim llega al cliente cuando refresca su ID token.
+    """
+    claim_name = ROLE_CLAIMS_CONFIG["claim_name"]
+    try:
+        if role is None:
+            role = get_user_context(uid).role
+
+        user = auth.get_user(uid)
+        claims = dict(user.custom_claims or {})
+        if claims.get(claim_name) == role:
+            return False
+
+        claims[claim_name] = role
+        auth.set_custom_user_claims(uid, claims)
+        print(f"✅ Claim de rol sincronizado para {uid}: {role}")
+        return True
+    except Exception as e:
+        print(f"❌ Error sincronizando claim de rol para {uid}: {e}")
+        return False
+
+def sync_all_role_claims():
+    """Sincroniza el claim de rol de todos los usuarios; retorna cuántos cambiaron"""
+    updated = 0
+    for user_doc in db.collection('users').stream():
+        role = (user_doc.to_dict() or {}).get('rol', 'free')
+        if sync_role_claim(user_doc.id, role):
+            updated += 1
+    return updated
+
+def watch_role_claims():
+    """
+    Mantiene los claims al día escuchando cambios en `users`.
+    Pensado para correr en un único proceso (ver sync_role_claims.py),
+    no en cada worker web.
+    """
+    def on_users_snapshot(col_snapshot, changes, read_time):
+        for change in changes:
+            if change.type.name == 'REMOVED':
+                continue
+            role = (change.document.to_dict() or {}).get('rol', 'free')
+            sync_role_claim(change.document.id, role)
+            invalidate_user_role(change.document.id)
+
+    return db.collection('users').on_snapshot(on_users_snapshot)
+
+def delete_recursive(*references):
+    """
+    Elimina documentos o colecciones junto con todas sus subcolecciones.
+    Usa BulkWriter (escrituras en lote y en paralelo) en lugar de un
+    delete por documento. Retorna la cantidad de documentos eliminados.
+    """
+    deleted = 0
+    for reference in references:
+        deleted += db.recursive_delete(reference)
+    return deleted
+
 def create_user_document(uid, user_data):
     """Crea el documento del usuario en Firestore"""
     try:
@@ -85,6 +315,9 @@ def create_user_document(uid, user_data):
             'fechaAlta': firestore.SERVER_TIMESTAMP,
             'rol': 'free'  # Por defecto free
         })
+        invalidate_user_role(uid)
+        if ROLE_CLAIMS_CONFIG["enabled"]:
+            sync_role_claim(uid, 'free')
         print(f"✅ Usuario creado en Firestore: {uid}")
         return True
     except Exception as e:
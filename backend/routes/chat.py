@@ -1,11 +1,15 @@
-from flask import Blueprint, request, jsonify
-from firebase_config import verify_firebase_token, get_user_role, db
+from flask import Blueprint, request, jsonify, Response, stream_with_context
+from firebase_config import verify_firebase_token, get_user_role, get_user_context, db
 from services.openai_assistant import assistant_manager
 from services.functions import execute_function
+from services.user_threads import send_user_message, stream_user_message, set_user_thread_id
+from services.assistant_jobs import submit_chat_job, get_chat_job
+from services.chat_history import save_exchange
+from services.assistant_files import upload_user_file, delete_user_file
 from datetime import datetime
+import json
 import logging
-import os
-import tempfile
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
 
 # Configurar logging
@@ -15,7 +19,9 @@ logger = logging.getLogger(__name__)
 chat_bp = Blueprint('chat', __name__)
 
 # Cargar configuración de archivos
-from config.assistant_config import FILE_CONFIG
+from config.assistant_config import FILE_CONFIG, PAGINATION_CONFIG
+from utils.pagination import encode_cursor, decode_cursor, get_page_size
+from utils.uploads import UploadRequest, upload_size, upload_digest
 
 ALLOWED_EXTENSIONS = set(FILE_CONFIG["allowed_extensions"])
 MAX_FILE_SIZE = FILE_CONFIG["max_file_size_mb"] * 1024 * 1024
@@ -25,44 +31,6 @@ def allowed_file(filename):
     return '.' in filename and \
            filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_user_thread_id(user_id: str) -> str:
-    """
-    Obtiene o crea un thread_id para el usuario desde Firebase
-    """
-    try:
-        # Buscar en Firestore si el usuario ya tiene un thread_id
-        user_doc = db.collection('users').document(user_id).get()
-        
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            thread_id = user_data.get('thread_id')
-            
-            if thread_id:
-                # Verificar que el thread aún existe en OpenAI
-                try:
-                    assistant_manager.client.beta.threads.retrieve(thread_id)
-                    logger.info(f"Thread existente encontrado para usuario {user_id}: {thread_id}")
-                    return thread_id
-                except Exception as e:
-                    logger.warning(f"Thread {thread_id} no existe, creando uno nuevo")
-        
-        # Crear nuevo thread
-        thread_id = assistant_manager.get_or_create_thread(user_id)
-        
-        # Guardar thread_id en Firestore
-        db.collection('users').document(user_id).update({
-            'thread_id': thread_id,
-            'fechaActualizacion': datetime.now()
-        })
-        
-        logger.info(f"Nuevo thread creado y guardado para usuario {user_id}: {thread_id}")
-        return thread_id
-        
-    except Exception as e:
-        logger.error(f"Error obteniendo thread_id para usuario {user_id}: {e}")
-        # Fallback: crear thread sin guardar en Firebase
-        return assistant_manager.get_or_create_thread(user_id)
-
 @chat_bp.route('/assistant/chat', methods=['POST'])
 def assistant_chat():
     """
@@ -80,7 +48,7 @@ def assistant_chat():
         return jsonify({'error': 'Token inválido'}), 401
     
     user_id = decoded_token['uid']
-    user_role = get_user_role(user_id)
+    user_role = get_user_role(user_id, decoded_token)
     
     # Verificar si el usuario es premium
     if user_role != 'premium':
@@ -96,9 +64,6 @@ def assistant_chat():
         if not message and not data.get('files'):
             return jsonify({'error': 'Mensaje requerido o archivos adjuntos'}), 400
         
-        # Obtener o crear thread_id para el usuario
-        thread_id = get_user_thread_id(user_id)
-        
         # Procesar archivos si los hay
         file_ids = []
         if 'files' in data and data['files']:
@@ -107,13 +72,14 @@ def assistant_chat():
                     # El url contiene el file_id que devolvió el endpoint de upload
                     file_ids.append(file_data['url'])
         
-        # Enviar mensaje al assistant
-        result = assistant_manager.send_message(thread_id, message, file_ids)
+        # Enviar mensaje al thread del usuario (se recrea solo si ya no existe)
+        received_at = datetime.now()
+        result = send_user_message(user_id, message, file_ids)
+        thread_id = result['thread_id']
         
         if result['success']:
             # Guardar mensaje en Firebase para historial
-            save_message_to_firebase(user_id, thread_id, 'user', message)
-            save_message_to_firebase(user_id, thread_id, 'assistant', result['message'])
+            save_exchange_to_firebase(user_id, result['conversation_id'], thread_id, message, result['message'], received_at)
             
             return jsonify({
                 'success': True,
@@ -131,6 +97,161 @@ def assistant_chat():
         logger.error(f"Error en assistant_chat: {e}")
         return jsonify({'error': 'Error interno del servidor'}), 500
 
+@chat_bp.route('/assistant/chat/stream', methods=['POST'])
+def assistant_chat_stream():
+    """
+    Chat con el assistant en streaming (Server-Sent Events).
+    Envía los fragmentos de texto a medida que el run los genera.
+    """
+    # Verificar autenticación
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return jsonify({'error': 'Token de autorización requerido'}), 401
+    
+    id_token = auth_header.split('Bearer ')[1]
+    decoded_token = verify_firebase_token(id_token)
+    
+    if not decoded_token:
+        return jsonify({'error': 'Token inválido'}), 401
+    
+    user_id = decoded_token['uid']
+    user_role = get_user_role(user_id, decoded_token)
+    
+    # Verificar si el usuario es premium
+    if user_role != 'premium':
+        return jsonify({'error': 'Se requiere cuenta premium para usar el assistant'}), 403
+    
+    data = request.get_json(silent=True)
+    if not data:
+        return jsonify({'error': 'Datos requeridos'}), 400
+    
+    message = data.get('message', '').strip()
+    if not message and not data.get('files'):
+        return jsonify({'error': 'Mensaje requerido o archivos adjuntos'}), 400
+    
+    file_ids = [
+        file_data['url'] for file_data in data.get('files') or []
+        if file_data.get('type') == 'image' and file_data.get('url')
+    ]
+    
+    received_at = datetime.now()
+    
+    def generate():
+        try:
+            for event in stream_user_message(user_id, message, file_ids):
+                if event['type'] == 'done':
+                    # Guardar mensaje en Firebase para historial
+                    save_exchange_to_firebase(
+                        user_id, event['conversation_id'], event['thread_id'], message, event['message'], received_at
+                    )
+                yield format_sse(event['type'], event)
+        except Exception as e:
+            logger.error(f"Error en assistant_chat_stream: {e}")
+            yield format_sse('error', {'type': 'error', 'error': 'Error interno del servidor'})
+    
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+
+def format_sse(event_type: str, data: dict) -> str:
+    """Formatea un evento Server-Sent Events"""
+    return f"event: {event_type}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@chat_bp.route('/assistant/chat/jobs', methods=['POST'])
+def submit_assistant_chat_job():
+    """
+    Encola un mensaje para el assistant y responde de inmediato con el job_id.
+    El resultado se consulta en GET /assistant/chat/jobs/<job_id>.
+    """
+    # Verificar autenticación
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return jsonify({'error': 'Token de autorización requerido'}), 401
+    
+    id_token = auth_header.split('Bearer ')[1]
+    decoded_token = verify_firebase_token(id_token)
+    
+    if not decoded_token:
+        return jsonify({'error': 'Token inválido'}), 401
+    
+    user_id = decoded_token['uid']
+    user_role = get_user_role(user_id, decoded_token)
+    
+    # Verificar si el usuario es premium
+    if user_role != 'premium':
+        return jsonify({'error': 'Se requiere cuenta premium para usar el assistant'}), 403
+    
+    try:
+        data = request.get_json()
+        if not data:
+            return jsonify({'error': 'Datos requeridos'}), 400
+        
+        message = data.get('message', '').strip()
+        if not message and not data.get('files'):
+            return jsonify({'error': 'Mensaje requerido o archivos adjuntos'}), 400
+        
+        file_ids = [
+            file_data['url'] for file_data in data.get('files') or []
+            if file_data.get('type') == 'image' and file_data.get('url')
+        ]
+        
+        received_at = datetime.now()
+        
+        def store_exchange(result):
+            # Guardar mensaje en Firebase para historial
+            save_exchange_to_firebase(
+                user_id, result['conversation_id'], result['thread_id'], message, result['message'], received_at
+            )
+        
+        try:
+            job_id = submit_chat_job(user_id, message, file_ids, on_success=store_exchange)
+        except RuntimeError:
+            return jsonify({'error': 'Servidor ocupado, intenta nuevamente en unos segundos'}), 503
+        
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'status': 'queued'
+        }), 202
+        
+    except Exception as e:
+        logger.error(f"Error encolando job de chat: {e}")
+        return jsonify({'error': 'Error interno del servidor'}), 500
+
+@chat_bp.route('/assistant/chat/jobs/<job_id>', methods=['GET'])
+def get_assistant_chat_job(job_id):
+    """
+    Estado de un job de chat. Con ?wait=N espera hasta N segundos a que
+    termine (long-poll) antes de responder.
+    """
+    # Verificar autenticación
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return jsonify({'error': 'Token de autorización requerido'}), 401
+    
+    id_token = auth_header.split('Bearer ')[1]
+    decoded_token = verify_firebase_token(id_token)
+    
+    if not decoded_token:
+        return jsonify({'error': 'Token inválido'}), 401
+    
+    user_id = decoded_token['uid']
+    
+    try:
+        wait = request.args.get('wait', 0, type=float)
+        job = get_chat_job(job_id, user_id, wait=wait)
+        
+        if not job:
+            return jsonify({'error': 'Job no encontrado'}), 404
+        
+        return jsonify({'success': True, **job})
+        
+    except Exception as e:
+        logger.error(f"Error obteniendo job {job_id}: {e}")
+        return jsonify({'error': 'Error obteniendo job'}), 500
+
 @chat_bp.route('/assistant/upload', methods=['POST'])
 def upload_file():
     """
@@ -148,7 +269,7 @@ def upload_file():
         return jsonify({'error': 'Token inválido'}), 401
     
     user_id = decoded_token['uid']
-    user_role = get_user_role(user_id)
+    user_role = get_user_role(user_id, decoded_token)
     
     # Verificar si el usuario es premium
     if user_role != 'premium':
@@ -156,10 +277,15 @@ def upload_file():
     
     try:
         # Verificar si hay archivo en la request
-        if 'file' not in request.files:
+        try:
+            files = request.files
+        except RequestEntityTooLarge:
+            return jsonify({'error': f'Archivo demasiado grande (máximo {FILE_CONFIG["max_file_size_mb"]}MB)'}), 413
+        
+        if 'file' not in files:
             return jsonify({'error': 'No se encontró archivo'}), 400
         
-        file = request.files['file']
+        file = files['file']
         if file.filename == '':
             return jsonify({'error': 'No se seleccionó archivo'}), 400
         
@@ -167,29 +293,25 @@ def upload_file():
         if not allowed_file(file.filename):
             return jsonify({'error': 'Tipo de archivo no permitido'}), 400
         
-        # Verificar tamaño
-        file.seek(0, 2)  # Ir al final del archivo
-        file_size = file.tell()
-        file.seek(0)  # Volver al inicio
+        # Verificar tamaño (medido mientras se recibía el archivo)
+        file_size = upload_size(file)
         
         if file_size > MAX_FILE_SIZE:
-            return jsonify({'error': 'Archivo demasiado grande (máximo 10MB)'}), 400
+            return jsonify({'error': f'Archivo demasiado grande (máximo {FILE_CONFIG["max_file_size_mb"]}MB)'}), 413
         
-        # Guardar archivo temporalmente
         filename = secure_filename(file.filename)
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{filename}") as temp_file:
-            file.save(temp_file.name)
-            temp_path = temp_file.name
         
         try:
-            # Subir archivo a OpenAI
-            file_id = assistant_manager.upload_file(temp_path)
+            # Subir archivo a OpenAI directo desde el buffer de la request
+            # (si el usuario ya subió el mismo contenido se reutiliza el file_id)
+            file_id, deduplicated = upload_user_file(user_id, file.stream, filename, upload_digest(file))
             
             return jsonify({
                 'success': True,
                 'file_id': file_id,
                 'filename': filename,
-                'size': file_size
+                'size': file_size,
+                'deduplicated': deduplicated
             })
             
         except Exception as upload_error:
@@ -198,19 +320,42 @@ def upload_file():
                 'success': False,
                 'error': f'Error subiendo archivo a OpenAI: {str(upload_error)}'
             }), 500
-            
-        finally:
-            # Limpiar archivo temporal
-            if os.path.exists(temp_path):
-                try:
-                    os.unlink(temp_path)
-                except Exception as cleanup_error:
-                    logger.warning(f"Error limpiando archivo temporal: {cleanup_error}")
                 
     except Exception as e:
         logger.error(f"Error subiendo archivo: {e}")
         return jsonify({'error': 'Error subiendo archivo'}), 500
 
+@chat_bp.route('/assistant/upload/<file_id>', methods=['DELETE'])
+def delete_uploaded_file(file_id):
+    """
+    Elimina un archivo subido por el usuario
+    """
+    # Verificar autenticación
+    auth_header = request.headers.get('Authorization')
+    if not auth_header or not auth_header.startswith('Bearer '):
+        return jsonify({'error': 'Token de autorización requerido'}), 401
+    
+    id_token = auth_header.split('Bearer ')[1]
+    decoded_token = verify_firebase_token(id_token)
+    
+    if not decoded_token:
+        return jsonify({'error': 'Token inválido'}), 401
+    
+    user_id = decoded_token['uid']
+    
+    try:
+        deleted = delete_user_file(user_id, file_id)
+        if deleted is None:
+            return jsonify({'error': 'Archivo no encontrado'}), 404
+        if not deleted:
+            return jsonify({'success': False, 'error': 'Error eliminando archivo'}), 500
+        
+        return jsonify({'success': True})
+        
+    except Exception as e:
+        logger.error(f"Error eliminando archivo {file_id}: {e}")
+        return jsonify({'error': 'Error eliminando archivo'}), 500
+
 @chat_bp.route('/assistant/history', methods=['GET'])
 def get_assistant_history():
     """
@@ -228,7 +373,7 @@ def get_assistant_history():
         return jsonify({'error': 'Token inválido'}), 401
     
     user_id = decoded_token['uid']
-    user_role = get_user_role(user_id)
+    user_role = get_user_role(user_id, decoded_token)
     
     # Verificar si el usuario es premium
     if user_role != 'premium':
@@ -236,23 +381,42 @@ def get_assistant_history():
     
     try:
         # Obtener thread_id del usuario
-        user_doc = db.collection('users').document(user_id).get()
-        if not user_doc.exists:
+        user_context = get_user_context(user_id)
+        if not user_context.exists:
             return jsonify({'error': 'Usuario no encontrado'}), 404
         
-        user_data = user_doc.to_dict()
-        thread_id = user_data.get('thread_id')
+        thread_id = user_context.thread_id
         
         if not thread_id:
             return jsonify({'messages': []})
         
-        # Obtener mensajes del thread
-        messages = assistant_manager.get_thread_messages(thread_id, limit=50)
+        page_size = get_page_size(
+            request.args,
+            PAGINATION_CONFIG["assistant_history_default_page_size"],
+            PAGINATION_CONFIG["assistant_history_max_page_size"]
+        )
+        try:
+            cursor = decode_cursor(request.args.get('cursor')) or {}
+        except ValueError:
+            return jsonify({'error': 'Cursor inválido'}), 400
+        
+        # Obtener una página de mensajes del thread (más recientes primero)
+        page = assistant_manager.get_thread_messages_page(
+            thread_id,
+            limit=page_size,
+            after=cursor.get('after'),
+            before=cursor.get('before')
+        )
         
         return jsonify({
             'success': True,
-            'messages': messages,
-            'thread_id': thread_id
+            # El resumen que siembra la compactación no es parte de la conversación visible
+            'messages': [msg for msg in page['messages'] if not msg.get('compaction_summary')],
+            'thread_id': thread_id,
+            # Mensajes más antiguos
+            'next_cursor': encode_cursor({'after': page['last_id']}) if page['has_more'] else None,
+            # Mensajes más nuevos que esta página
+            'prev_cursor': encode_cursor({'before': page['first_id']}) if cursor and page['first_id'] else None
         })
         
     except Exception as e:
@@ -276,7 +440,7 @@ def clear_assistant_history():
         return jsonify({'error': 'Token inválido'}), 401
     
     user_id = decoded_token['uid']
-    user_role = get_user_role(user_id)
+    user_role = get_user_role(user_id, decoded_token)
     
     # Verificar si el usuario es premium
     if user_role != 'premium':
@@ -284,23 +448,18 @@ def clear_assistant_history():
     
     try:
         # Obtener thread_id del usuario
-        user_doc = db.collection('users').document(user_id).get()
-        if user_doc.exists:
-            user_data = user_doc.to_dict()
-            thread_id = user_data.get('thread_id')
-            
-            if thread_id:
-                # Eliminar thread existente
-                assistant_manager.delete_thread(thread_id)
+        user_context = get_user_context(user_id)
+        thread_id = user_context.thread_id
+        
+        if thread_id:
+            # Eliminar thread existente
+            assistant_manager.delete_thread(thread_id)
         
         # Crear nuevo thread
         new_thread_id = assistant_manager.get_or_create_thread(user_id)
         
         # Actualizar en Firebase
-        db.collection('users').document(user_id).update({
-            'thread_id': new_thread_id,
-            'fechaActualizacion': datetime.now()
-        })
+        set_user_thread_id(user_id, new_thread_id)
         
         return jsonify({
             'success': True,
@@ -329,7 +488,7 @@ def analyze_image():
         return jsonify({'error': 'Token inválido'}), 401
     
     user_id = decoded_token['uid']
-    user_role = get_user_role(user_id)
+    user_role = get_user_role(user_id, decoded_token)
     
     # Verificar si el usuario es premium
     if user_role != 'premium':
@@ -343,10 +502,33 @@ def analyze_image():
         image_url = data.get('image_url', '').strip()
         analysis_type = data.get('analysis_type', 'complete')
         prompt = data.get('prompt', '').strip()
+        mode = data.get('mode', 'context')
         
         if not image_url:
             return jsonify({'error': 'URL de imagen requerida'}), 400
         
+        if mode not in ('context', 'image'):
+            return jsonify({'error': 'Modo inválido (context o image)'}), 400
+        
+        # Modo "image": la imagen va una sola vez al assistant como parte del
+        # mensaje, sin análisis previo (requiere una URL pública, no data URL)
+        if prompt and mode == 'image' and not image_url.startswith('data:'):
+            assistant_result = send_user_message(user_id, prompt, image_urls=[image_url])
+            
+            if not assistant_result['success']:
+                return jsonify({
+                    'success': False,
+                    'error': assistant_result['error']
+                }), 500
+            
+            return jsonify({
+                'success': True,
+                'analysis': assistant_result['message'],
+                'assistant_analysis': assistant_result['message'],
+                'image_url': image_url,
+                'analysis_type': analysis_type
+            })
+        
         # Ejecutar análisis de imagen
         result = execute_function('analyze_image', {
             'image_url': image_url,
@@ -354,12 +536,15 @@ def analyze_image():
         })
         
         if result['success']:
-            # Si hay un prompt adicional, enviarlo al assistant
+            # Si hay un prompt adicional, enviarlo al assistant junto con el
+            # análisis como texto (la imagen no se vuelve a procesar)
             if prompt:
-                thread_id = get_user_thread_id(user_id)
-                full_message = f"Analiza esta imagen: {image_url}\n\nPrompt adicional: {prompt}"
+                full_message = (
+                    f"Análisis del gráfico adjuntado por el usuario ({result['analysis_type']}):\n"
+                    f"{result['analysis']}\n\nPrompt adicional: {prompt}"
+                )
                 
-                assistant_result = assistant_manager.send_message(thread_id, full_message, [image_url])
+                assistant_result = send_user_message(user_id, full_message)
                 
                 if assistant_result['success']:
                     result['assistant_analysis'] = assistant_result['message']
@@ -381,33 +566,34 @@ def analyze_image():
         logger.error(f"Error analizando imagen: {e}")
         return jsonify({'error': 'Error analizando imagen'}), 500
 
-def save_message_to_firebase(user_id: str, thread_id: str, sender: str, text: str):
+def save_exchange_to_firebase(user_id: str, conversation_id: str, thread_id: str, user_text: str,
+                              assistant_text: str, user_timestamp: datetime = None):
     """
-    Guarda un mensaje en Firebase para el historial
+    Guarda en Firebase el mensaje del usuario y la respuesta del assistant
+    (un solo commit) para el historial. La conversación se identifica por
+    `conversation_id`, que no cambia cuando se compacta el thread.
     """
     try:
-        # Crear documento de chat si no existe
-        chat_ref = db.collection('chats').document(user_id).collection('conversations').document(thread_id)
-        
-        # Guardar mensaje
-        chat_ref.collection('messages').add({
-            'sender': sender,
-            'text': text,
-            'timestamp': datetime.now(),
-            'thread_id': thread_id
-        })
-        
-        # Actualizar metadata del chat
-        chat_ref.set({
-            'thread_id': thread_id,
-            'user_id': user_id,
-            'created_at': datetime.now(),
-            'last_message': datetime.now()
-        }, merge=True)
+        chat_ref = db.collection('chats').document(user_id).collection('conversations').document(conversation_id)
+        
+        save_exchange(
+            chat_ref,
+            user_id,
+            user_text,
+            assistant_text,
+            user_timestamp=user_timestamp,
+            message_fields={'thread_id': thread_id},
+            chat_fields={'thread_id': thread_id}
+        )
         
     except Exception as e:
-        logger.error(f"Error guardando mensaje en Firebase: {e}")
+        logger.error(f"Error guardando mensajes en Firebase: {e}")
 
 # Registrar blueprint en la aplicación principal
 def init_app(app):
+    # Las subidas se reciben en memoria y se cortan al superar el máximo
+    app.request_class = UploadRequest
+    if not app.config.get('MAX_CONTENT_LENGTH'):
+        # Margen de 1MB para el resto del multipart
+        app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE + 1024 * 1024
     app.register_blueprint(chat_bp, url_prefix='/api') 
\ No newline at end of file
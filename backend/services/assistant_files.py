@@ -0,0 +1,100 @@
+from datetime import datetime, timedelta, timezone
+from typing import BinaryIO, Optional, Tuple
+import logging
+
+from config.assistant_config import FILE_CONFIG
+from firebase_config import db
+from services.openai_assistant import assistant_manager
+from utils.images import prepare_upload
+
+# Configurar logging
+logger = logging.getLogger(__name__)
+
+# Los archivos subidos se registran en users/{uid}/files/{sha256}: el
+# registro es la prueba de pertenencia para borrarlos y, mientras no
+# venza (`dedup_ttl_hours`, acorde a lo que viven los archivos en
+# OpenAI), el índice de deduplicación. Al ser Firestore vale para todos
+# los workers y sobrevive a los reinicios.
+FILES_SUBCOLLECTION = 'files'
+
+def upload_user_file(user_id: str, file: BinaryIO, filename: str, digest: str) -> Tuple[str, bool]:
+    """
+    Sube el archivo del usuario a OpenAI salvo que ya se haya subido el
+    mismo contenido. Retorna (file_id, deduplicado).
+    """
+    if FILE_CONFIG["dedup_enabled"]:
+        file_id = _find_file_id(user_id, digest)
+        if file_id:
+            logger.info(f"Archivo deduplicado para usuario {user_id}: {file_id}")
+            return file_id, True
+
+    # Reducir la imagen antes de subirla (el registro usa el digest del original)
+    file, filename = prepare_upload(file, filename)
+    file_id = assistant_manager.upload_file(file, filename)
+    _record_file(user_id, digest, file_id, filename)
+    return file_id, False
+
+def delete_user_file(user_id: str, file_id: str) -> Optional[bool]:
+    """
+    Quita los registros del archivo del usuario y lo elimina de OpenAI
+    cuando ningún otro usuario lo referencia. Retorna None si el archivo
+    no pertenece al usuario.
+    """
+    records = list(_user_files_ref(user_id).where('file_id', '==', file_id).stream())
+    if not records:
+        return None
+
+    if not (FILE_CONFIG["dedup_global"] and _shared_with_others(user_id, file_id)):
+        # Si OpenAI falla se conservan los registros para poder reintentar
+        if not assistant_manager.delete_file(file_id):
+            return False
+
+    batch = db.batch()
+    for record in records:
+        batch.delete(record.reference)
+    batch.commit()
+    return True
+
+def _user_files_ref(user_id: str):
+    return db.collection('users').document(user_id).collection(FILES_SUBCOLLECTION)
+
+def _find_file_id(user_id: str, digest: str) -> Optional[str]:
+    """file_id vigente para el contenido: primero del usuario y, con `dedup_global`, de cualquiera"""
+    now = datetime.now(timezone.utc)
+    record = _user_files_ref(user_id).document(digest).get()
+    if record.exists and record.get('expires_at') > now:
+        return record.get('file_id')
+
+    if not FILE_CONFIG["dedup_global"]:
+        return None
+
+    # Requiere un índice de grupo de colecciones sobre files.sha256
+    shared = (
+        db.collection_group(FILES_SUBCOLLECTION)
+        .where('sha256', '==', digest)
+        .where('expires_at', '>', now)
+        .limit(1)
+        .get()
+    )
+    if not shared:
+        return None
+
+    # El usuario queda como dueño del file_id compartido, con el mismo vencimiento
+    data = shared[0].to_dict()
+    _user_files_ref(user_id).document(digest).set({**data, 'created_at': now})
+    return data['file_id']
+
+def _record_file(user_id: str, digest: str, file_id: str, filename: str):
+    now = datetime.now(timezone.utc)
+    _user_files_ref(user_id).document(digest).set({
+        'file_id': file_id,
+        'sha256': digest,
+        'filename': filename,
+        'created_at': now,
+        'expires_at': now + timedelta(hours=FILE_CONFIG["dedup_ttl_hours"])
+    })
+
+def _shared_with_others(user_id: str, file_id: str) -> bool:
+    """Indica si otro usuario tiene registrado el mismo file_id (requiere índice sobre files.file_id)"""
+    owners = db.collection_group(FILES_SUBCOLLECTION).where('file_id', '==', file_id).stream()
+    return any(owner.reference.parent.parent.id != user_id for owner in owners)
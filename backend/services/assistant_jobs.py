@@ -0,0 +1,112 @@
+from datetime import datetime, timedelta
+from typing import Optional, List, Dict, Any, Callable
+import logging
+import time
+
+from firebase_config import db
+from services.openai_assistant import assistant_manager
+from services.user_threads import send_user_message
+
+# Configurar logging
+logger = logging.getLogger(__name__)
+
+# Los jobs viven en memoria del proceso que los ejecuta; se reflejan en
+# Firestore para que cualquier worker pueda responder el estado.
+JOBS_COLLECTION = 'assistant_jobs'
+
+def submit_chat_job(user_id: str, message: str, file_ids: Optional[List[str]] = None,
+                    on_success: Optional[Callable[[Dict[str, Any]], None]] = None) -> str:
+    """
+    Encola el envío de un mensaje al assistant y retorna el job_id.
+    `on_success` recibe el resultado cuando el run termina bien
+    (por ejemplo, para guardar el intercambio en el historial).
+    """
+    job_ref = db.collection(JOBS_COLLECTION).document()
+
+    def run():
+        _mark_job_running(job_ref)
+        try:
+            result = send_user_message(user_id, message, file_ids)
+            if result['success'] and on_success:
+                on_success(result)
+        except Exception as e:
+            logger.error(f"Error en job {job_ref.id}: {e}")
+            result = {'success': False, 'error': str(e)}
+        _save_job_state(job_ref, 'completed' if result['success'] else 'failed', result)
+        return result
+
+    ttl_seconds = assistant_manager.job_config["result_ttl_seconds"]
+    job_ref.set({
+        'owner': user_id,
+        'status': 'queued',
+        'created_at': datetime.now(),
+        # Campo para una política TTL de Firestore sobre la colección
+        'expires_at': datetime.now() + timedelta(seconds=ttl_seconds)
+    })
+
+    try:
+        assistant_manager.submit_job(run, owner=user_id, job_id=job_ref.id)
+    except RuntimeError as e:
+        _save_job_state(job_ref, 'failed', {'success': False, 'error': str(e)})
+        raise
+
+    return job_ref.id
+
+def get_chat_job(job_id: str, user_id: str, wait: float = 0) -> Optional[Dict[str, Any]]:
+    """
+    Retorna el estado del job si pertenece al usuario. Con `wait` > 0 hace
+    long-poll hasta que el job termine o venza la espera.
+    """
+    wait = min(max(wait, 0), assistant_manager.job_config["max_wait_seconds"])
+
+    job = assistant_manager.get_job(job_id, wait=wait)
+    if job is not None:
+        if job['owner'] != user_id:
+            return None
+        return _public_job(job_id, job['status'], job['result'])
+
+    # El job lo ejecuta otro worker: consultar su reflejo en Firestore
+    deadline = time.time() + wait
+    while True:
+        job_doc = db.collection(JOBS_COLLECTION).document(job_id).get()
+        if not job_doc.exists:
+            return None
+
+        job_data = job_doc.to_dict()
+        if job_data.get('owner') != user_id:
+            return None
+
+        status = job_data.get('status')
+        if status in ('completed', 'failed') or time.time() >= deadline:
+            return _public_job(job_id, status, job_data.get('result'))
+
+        time.sleep(1)
+
+def _mark_job_running(job_ref):
+    """Refleja en Firestore que el job empezó (lo ven los demás workers)"""
+    try:
+        job_ref.update({
+            'status': 'running',
+            'started_at': datetime.now()
+        })
+    except Exception as e:
+        logger.error(f"Error guardando estado del job {job_ref.id}: {e}")
+
+def _save_job_state(job_ref, status: str, result: Dict[str, Any]):
+    """Refleja el estado final del job en Firestore"""
+    try:
+        job_ref.set({
+            'status': status,
+            'result': result,
+            'finished_at': datetime.now()
+        }, merge=True)
+    except Exception as e:
+        logger.error(f"Error guardando estado del job {job_ref.id}: {e}")
+
+def _public_job(job_id: str, status: str, result: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Forma de respuesta del endpoint de estado"""
+    return {
+        'job_id': job_id,
+        'status': status,
+        'result': result
+    }
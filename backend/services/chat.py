@@ -1,7 +1,13 @@
 from openai import OpenAI
 import os
 from dotenv import load_dotenv
+import hashlib
 import json
+from functools import lru_cache
+from config.assistant_config import IMAGE_ANALYSIS_CONFIG, CONTEXT_BUDGET_CONFIG
+from utils.tokens import count_tokens, count_message_tokens, message_text, truncate_to_tokens, MESSAGE_OVERHEAD_TOKENS
+from utils.analysis_cache import analysis_cache, analysis_cache_key
+from utils.images import prepare_vision_image
 
 load_dotenv()  # Esto carga las variables del .env
 
@@ -137,6 +143,60 @@ def customize_context(base_context, custom_elements=None):
     
     return base_context + custom_section
 
+@lru_cache(maxsize=1)
+def get_default_system_prompt():
+    """Contexto de Mentor Forex, armado una sola vez por proceso"""
+    return load_mentor_forex_context()
+
+@lru_cache(maxsize=32)
+def _system_prompt_tokens(system_prompt, model):
+    """Tokens del prompt del sistema (se repite en cada llamada)"""
+    return count_tokens(system_prompt, model) + MESSAGE_OVERHEAD_TOKENS
+
+def build_chat_context(prompt, model, system_prompt=None, conversation_history=None):
+    """
+    Arma los mensajes para el modelo dentro del presupuesto de tokens de
+    CONTEXT_BUDGET_CONFIG: recorta mensajes largos del historial y, si no
+    entra completo, descarta los más antiguos. Retorna (messages, max_tokens)
+    con max_tokens ajustado a lo que queda de la ventana del modelo.
+    """
+    budget = CONTEXT_BUDGET_CONFIG["models"].get(model, CONTEXT_BUDGET_CONFIG["default_model_budget"])
+    max_response = CONTEXT_BUDGET_CONFIG["max_response_tokens"]
+    min_response = CONTEXT_BUDGET_CONFIG["min_response_tokens"]
+    input_budget = min(budget["max_input_tokens"], budget["context_window"] - min_response)
+
+    system_prompt = system_prompt or get_default_system_prompt()
+    user_message = {"role": "user", "content": prompt}
+    used = _system_prompt_tokens(system_prompt, model) + count_message_tokens([user_message], model)
+
+    # Historial del más reciente al más antiguo hasta agotar el presupuesto
+    history = []
+    omitted = 0
+    for index, message in enumerate(reversed(conversation_history or [])):
+        text = message_text(message)
+        max_message_tokens = CONTEXT_BUDGET_CONFIG["max_history_message_tokens"]
+        if isinstance(message.get("content"), str) and count_tokens(text, model) > max_message_tokens:
+            message = {**message, "content": truncate_to_tokens(text, max_message_tokens, model)}
+
+        tokens = count_tokens(message_text(message), model) + MESSAGE_OVERHEAD_TOKENS
+        if used + tokens > input_budget:
+            omitted = len(conversation_history) - index
+            break
+        history.append(message)
+        used += tokens
+
+    messages = [{"role": "system", "content": system_prompt}]
+    if omitted:
+        messages.append({
+            "role": "system",
+            "content": f"(Se omitieron {omitted} mensajes anteriores de la conversación por longitud)"
+        })
+    messages.extend(reversed(history))
+    messages.append(user_message)
+
+    max_tokens = max(min(max_response, budget["context_window"] - used), min_response)
+    return messages, max_tokens
+
 def get_gpt_response(prompt, model="gpt-4o", system_prompt=None, temperature=0.7, conversation_history=None):
     """
     Obtiene respuesta de GPT optimizada para trading con contexto de conversación
@@ -149,26 +209,16 @@ def get_gpt_response(prompt, model="gpt-4o", system_prompt=None, temperature=0.7
         conversation_history: Lista de mensajes previos para mantener contexto
     """
     
-    # Prompt del sistema por defecto para trading con contexto de Mentor Forex
-    if not system_prompt:
-        system_prompt = load_mentor_forex_context()
-    
-    # Construir el array de mensajes con contexto
-    messages = [{"role": "system", "content": system_prompt}]
-    
-    # Agregar historial de conversación si existe
-    if conversation_history:
-        messages.extend(conversation_history)
-    
-    # Agregar el mensaje actual
-    messages.append({"role": "user", "content": prompt})
+    # Prompt del sistema (por defecto, el contexto de Mentor Forex) + historial
+    # dentro del presupuesto de tokens del modelo
+    messages, max_tokens = build_chat_context(prompt, model, system_prompt, conversation_history)
     
     try:
         response = client.chat.completions.create(
             model=model,
             messages=messages,
             temperature=temperature,
-            max_tokens=4000,  # Suficiente para análisis detallado
+            max_tokens=max_tokens,  # Lo que queda de la ventana, hasta max_response_tokens
             stream=False  # Para respuestas completas
         )
         return response.choices[0].message.content
@@ -205,26 +255,38 @@ def get_quick_analysis(prompt, conversation_history=None):
 
 def analyze_chart_image(image_url, prompt=""):
     """
-    Para análisis de imágenes de gráficos (requiere GPT-4o con visión)
+    Para análisis de imágenes de gráficos (requiere GPT-4o con visión).
+    El resultado se cachea por imagen + prompt.
     """
-    try:
+    system_prompt = "Eres un experto en análisis técnico. Analiza este gráfico de trading identificando patrones, tendencias, soportes, resistencias y posibles señales de entrada/salida."
+    user_prompt = f"Analiza este gráfico de trading: {prompt}"
+
+    def run_analysis():
+        # Reducir la imagen antes de enviarla (menos tokens de visión)
+        vision_url, detail = prepare_vision_image(image_url)
         response = client.chat.completions.create(
             model="gpt-4o",
             messages=[
                 {
                     "role": "system",
-                    "content": "Eres un experto en análisis técnico. Analiza este gráfico de trading identificando patrones, tendencias, soportes, resistencias y posibles señales de entrada/salida."
+                    "content": system_prompt
                 },
                 {
                     "role": "user",
                     "content": [
-                        {"type": "text", "text": f"Analiza este gráfico de trading: {prompt}"},
-                        {"type": "image_url", "image_url": {"url": image_url}}
+                        {"type": "text", "text": user_prompt},
+                        {"type": "image_url", "image_url": {"url": vision_url, "detail": detail}}
                     ]
                 }
             ],
             max_tokens=2000
         )
         return response.choices[0].message.content
+
+    try:
+        prompt_hash = hashlib.sha256(f"{system_prompt}\n{user_prompt.strip()}".encode()).hexdigest()
+        cache_key = analysis_cache_key(image_url, "chart", IMAGE_ANALYSIS_CONFIG["prompt_version"], prompt_hash)
+        analysis, _ = analysis_cache.get_or_compute(cache_key, run_analysis)
+        return analysis
     except Exception as e:
-        return f"Error al analizar la imagen: {str(e)}"
\ No newline at end of file
+        return f"Error al analizar la imagen: {str(e)}"
@@ -0,0 +1,120 @@
+from datetime import datetime
+from typing import Optional, Dict, Any
+
+from firebase_admin import firestore
+from google.api_core.exceptions import NotFound
+
+from firebase_config import db
+from config.assistant_config import CHAT_HISTORY_CONFIG
+
+def message_preview(text: str) -> str:
+    """Resumen corto del mensaje para mostrar en listados"""
+    text = (text or '').strip()
+    limit = CHAT_HISTORY_CONFIG["preview_length"]
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+def new_chat_fields(user_id: str) -> Dict[str, Any]:
+    """
+    Campos de una conversación nueva. `message_count_tracked` indica que
+    `message_count` se mantuvo desde la creación y es confiable aunque sea 0.
+    `last_message` arranca en la creación para que la conversación entre en
+    los listados ordenados por actividad aunque todavía no tenga mensajes.
+    """
+    now = datetime.now()
+    return {
+        'created_at': now,
+        'last_message': now,
+        'user_id': user_id,
+        'message_count_tracked': True
+    }
+
+def save_exchange(chat_ref, user_id: str, user_text: str, assistant_text: str,
+                  user_timestamp: Optional[datetime] = None, message_fields: Optional[Dict[str, Any]] = None,
+                  chat_fields: Optional[Dict[str, Any]] = None, assistant_sender: str = 'assistant'):
+    """
+    Guarda un intercambio completo (mensaje del usuario + respuesta) y la
+    metadata de la conversación en un único commit.
+
+    Primero intenta actualizar la conversación existente; solo si no
+    existe la crea, y recién ahí escribe `created_at`.
+    """
+    user_timestamp = user_timestamp or datetime.now()
+    now = datetime.now()
+
+    def commit(create: bool):
+        batch = db.batch()
+        messages_ref = chat_ref.collection('messages')
+
+        batch.set(messages_ref.document(), {
+            'sender': 'user',
+            'text': user_text,
+            'timestamp': user_timestamp,
+            **(message_fields or {})
+        })
+        batch.set(messages_ref.document(), {
+            'sender': assistant_sender,
+            'text': assistant_text,
+            'timestamp': now,
+            **(message_fields or {})
+        })
+
+        conversation = {
+            'message_count': firestore.Increment(2),
+            'last_message': now,
+            'last_message_preview': message_preview(assistant_text),
+            'last_sender': assistant_sender,
+            **(chat_fields or {})
+        }
+        if create:
+            batch.set(chat_ref, {**new_chat_fields(user_id), **conversation}, merge=True)
+        else:
+            batch.update(chat_ref, conversation)
+
+        batch.commit()
+
+    try:
+        commit(create=False)
+    except NotFound:
+        # Primera vez: la conversación todavía no existe
+        commit(create=True)
+
+def chat_has_messages(chat_data: Dict[str, Any]) -> Optional[bool]:
+    """
+    Indica si la conversación tiene mensajes usando solo sus contadores.
+    Retorna None cuando no se puede saber (documentos anteriores a los
+    contadores) y hay que consultar la subcolección.
+    """
+    message_count = chat_data.get('message_count')
+    if isinstance(message_count, int) and message_count > 0:
+        return True
+    if chat_data.get('message_count_tracked'):
+        return False
+    return None
+
+def last_activity(chat_data: Dict[str, Any]) -> Optional[datetime]:
+    """Fecha del último mensaje o, si no hay, de creación (naive)"""
+    value = chat_data.get('last_message') or chat_data.get('created_at')
+    if not isinstance(value, datetime):
+        return None
+    return value.replace(tzinfo=None)
+
+def backfill_last_message(chats) -> int:
+    """
+    Completa `last_message` en las conversaciones anteriores al campo
+    (order_by en Firestore omite los documentos que no lo tienen). Usa la
+    fecha de creación. Retorna la cantidad de documentos actualizados.
+    """
+    batch = db.batch()
+    updated = 0
+    for chat in chats:
+        chat_data = chat.to_dict()
+        if chat_data.get('last_message') is not None:
+            continue
+        batch.update(chat.reference, {'last_message': last_activity(chat_data) or datetime.now()})
+        updated += 1
+        if updated % 500 == 0:
+            batch.commit()
+            batch = db.batch()
+    if updated % 500:
+        batch.commit()
+    return updated
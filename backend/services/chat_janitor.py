@@ -0,0 +1,160 @@
+from datetime import datetime
+from typing import Dict, Any
+import heapq
+import logging
+import threading
+import time
+
+from firebase_config import db, delete_recursive
+from config.assistant_config import JANITOR_CONFIG
+from services.chat_history import chat_has_messages, last_activity, backfill_last_message
+from utils.cache import TTLCache
+
+# Configurar logging
+logger = logging.getLogger(__name__)
+
+def limit_chats(user_id):
+    """Limita a 5 chats por usuario, eliminando los de actividad más antigua"""
+    try:
+        chats_ref = db.collection('chats').document(user_id).collection('conversations')
+        
+        # Por última actividad, no por creación: la conversación del assistant
+        # es antigua pero sigue en uso. Se ordena acá porque los documentos
+        # viejos pueden no tener `last_message` (y de paso se completa)
+        chat_list = list(chats_ref.stream())
+        backfill_last_message(chat_list)
+        chat_list.sort(key=lambda chat: last_activity(chat.to_dict()) or datetime.min, reverse=True)
+        if len(chat_list) > 5:
+            # Eliminar chats sin actividad reciente junto con sus mensajes
+            delete_recursive(*[chat.reference for chat in chat_list[5:]])
+        
+        # Limpiar chats vacíos antiguos (más de 1 hora sin mensajes)
+        clean_empty_chats(user_id)
+    except Exception as e:
+        logger.error(f"Error limitando chats: {e}")
+
+def clean_empty_chats(user_id):
+    """Elimina chats vacíos que tienen más de 1 hora sin mensajes"""
+    try:
+        chats_ref = db.collection('chats').document(user_id).collection('conversations')
+        chats = chats_ref.stream()
+        
+        for chat in chats:
+            chat_data = chat.to_dict()
+            created_at = chat_data.get('created_at', datetime.now())
+            
+            # Asegurar que created_at sea un datetime
+            if not isinstance(created_at, datetime):
+                created_at = datetime.now()
+            
+            # Verificar si el chat tiene mensajes (contadores primero, consulta solo si no se sabe)
+            has_messages = chat_has_messages(chat_data)
+            if has_messages is None:
+                messages = chat.reference.collection('messages').limit(1).stream()
+                has_messages = len(list(messages)) > 0
+            
+            # Si no tiene mensajes y es más antiguo que 1 hora, eliminarlo
+            # Convertir created_at a datetime naive si es necesario
+            created_at_naive = created_at.replace(tzinfo=None)
+                
+            if not has_messages and (datetime.now() - created_at_naive).total_seconds() > 3600:
+                delete_recursive(chat.reference)
+                logger.info(f"Chat vacío eliminado: {chat.id}")
+                
+    except Exception as e:
+        logger.error(f"Error limpiando chats vacíos: {e}")
+
+class ChatJanitor:
+    """
+    Ejecuta la limpieza de chats fuera del request.
+
+    Los endpoints marcan al usuario como "sucio" y siguen; un pool acotado
+    de threads procesa la cola. Cada usuario se procesa como máximo una vez
+    por `interval_seconds` y las marcas repetidas mientras espera se
+    agrupan en una sola pasada.
+    """
+
+    def __init__(self, interval_seconds: float, max_workers: int, max_tracked_users: int):
+        self.interval_seconds = interval_seconds
+        self.max_workers = max_workers
+        self._schedule = []  # heap de (vence_en, user_id)
+        self._pending = set()
+        self._last_run = TTLCache(max_entries=max_tracked_users, default_ttl=interval_seconds)
+        self._cond = threading.Condition()
+        self._workers = []
+        self._metrics = {
+            'marked': 0,
+            'coalesced': 0,
+            'processed': 0,
+            'errors': 0,
+            'last_duration_ms': None
+        }
+
+    def mark_dirty(self, user_id: str):
+        """Agenda la limpieza del usuario (no bloquea)"""
+        with self._cond:
+            self._ensure_workers()
+            self._metrics['marked'] += 1
+            if user_id in self._pending:
+                self._metrics['coalesced'] += 1
+                return
+
+            last_run = self._last_run.get(user_id)
+            due_at = time.time() if last_run is None else last_run + self.interval_seconds
+            heapq.heappush(self._schedule, (due_at, user_id))
+            self._pending.add(user_id)
+            self._cond.notify()
+
+    def _ensure_workers(self):
+        """Arranca los threads en el primer uso (después del fork de gunicorn)"""
+        if self._workers:
+            return
+        for index in range(self.max_workers):
+            worker = threading.Thread(target=self._run, name=f"chat-janitor-{index}", daemon=True)
+            worker.start()
+            self._workers.append(worker)
+
+    def _next_user(self) -> str:
+        """Espera hasta que venza el próximo usuario agendado"""
+        with self._cond:
+            while True:
+                now = time.time()
+                if self._schedule and self._schedule[0][0] <= now:
+                    _, user_id = heapq.heappop(self._schedule)
+                    self._pending.discard(user_id)
+                    self._last_run.set(user_id, now)
+                    return user_id
+                timeout = self._schedule[0][0] - now if self._schedule else None
+                self._cond.wait(timeout=timeout)
+
+    def _run(self):
+        while True:
+            user_id = self._next_user()
+            start_time = time.time()
+            succeeded = True
+            try:
+                limit_chats(user_id)
+            except Exception as e:
+                succeeded = False
+                logger.error(f"Error en limpieza de chats para {user_id}: {e}")
+            
+            with self._cond:
+                self._metrics['processed' if succeeded else 'errors'] += 1
+                self._metrics['last_duration_ms'] = round((time.time() - start_time) * 1000)
+
+    def stats(self) -> Dict[str, Any]:
+        """Métricas para monitoreo"""
+        with self._cond:
+            return {
+                **self._metrics,
+                'queued': len(self._pending),
+                'workers': len(self._workers),
+                'interval_seconds': self.interval_seconds
+            }
+
+# Instancia global del janitor
+chat_janitor = ChatJanitor(
+    interval_seconds=JANITOR_CONFIG["interval_seconds"],
+    max_workers=JANITOR_CONFIG["max_workers"],
+    max_tracked_users=JANITOR_CONFIG["max_tracked_users"]
+)
@@ -1,10 +1,16 @@
 import requests
 import json
 import logging
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, List
 from datetime import datetime
 import os
 from openai import OpenAI
+from config.assistant_config import EXTERNAL_APIS, IMAGE_ANALYSIS_CONFIG
+from utils.cache import LoadingCache
+from utils.analysis_cache import analysis_cache, analysis_cache_key
+from utils.images import prepare_vision_image, load_image_bytes, dhash
+from utils.phash_index import PerceptualIndex
+from utils.http_client import get_json
 
 # Configurar logging
 logger = logging.getLogger(__name__)
@@ -12,6 +18,81 @@ logger = logging.getLogger(__name__)
 # Cliente OpenAI para análisis de imágenes
 openai_client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
 
+# Índice de hashes perceptuales de gráficos ya analizados (reutiliza análisis de imágenes casi iguales)
+near_duplicates = PerceptualIndex(
+    max_entries=IMAGE_ANALYSIS_CONFIG["near_duplicate_max_entries"],
+    ttl=IMAGE_ANALYSIS_CONFIG["near_duplicate_ttl_seconds"],
+    hash_bits=IMAGE_ANALYSIS_CONFIG["near_duplicate_hash_size"] ** 2,
+    enabled=IMAGE_ANALYSIS_CONFIG["near_duplicate_enabled"]
+)
+
+# Máximo de símbolos aceptados por get_prices
+MAX_SYMBOLS_PER_REQUEST = 20
+
+# Caché compartida de cotizaciones (TTL por fuente, single-flight y stale-while-revalidate)
+quote_cache = LoadingCache(max_entries=512)
+
+def _cached_quote(source: str, key: str, loader):
+    """Obtiene una cotización de la caché usando el TTL configurado para la fuente"""
+    api_config = EXTERNAL_APIS[source]
+    return quote_cache.get_or_load(
+        (source, key),
+        loader,
+        ttl=api_config["cache_ttl_seconds"],
+        stale_ttl=api_config["stale_ttl_seconds"]
+    )
+
+def _fetch_coingecko_prices(coin_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Consulta CoinGecko para una o varias monedas en una sola llamada.
+    Retorna {coin_id: cotización}; lanza excepción si falla.
+    """
+    params = {
+        "ids": ",".join(coin_ids),
+        "vs_currencies": "usd,eur",
+        "include_24hr_change": "true",
+        "include_24hr_vol": "true",
+        "include_market_cap": "true"
+    }
+    
+    data = get_json("coingecko", "/simple/price", params=params)
+    fetched_at = datetime.now().isoformat()
+    return {
+        coin_id: {"data": data.get(coin_id, {}), "fetched_at": fetched_at}
+        for coin_id in coin_ids
+    }
+
+def _prefetch_crypto_quotes(coin_ids: List[str]):
+    """
+    Carga en la caché, con una sola llamada, las monedas que no estén
+    frescas. Comparte el single-flight con get_crypto_price: las monedas
+    que otro request ya está cargando se esperan en lugar de repetirse.
+    """
+    def load(keys):
+        quotes = _fetch_coingecko_prices([coin_id for _, coin_id in keys])
+        return {("coingecko", coin_id): quote for coin_id, quote in quotes.items()}
+    
+    api_config = EXTERNAL_APIS["coingecko"]
+    quote_cache.get_or_load_many(
+        [("coingecko", coin_id) for coin_id in coin_ids],
+        load,
+        ttl=api_config["cache_ttl_seconds"],
+        stale_ttl=api_config["stale_ttl_seconds"]
+    )
+
+def _fetch_exchange_rates(base_currency: str) -> Dict[str, Any]:
+    """Consulta todas las tasas de ExchangeRate-API para una moneda base"""
+    data = get_json("exchangerate", f"/latest/{base_currency}")
+    
+    return {
+        "rates": data.get("rates", {}),
+        "fetched_at": datetime.now().isoformat()
+    }
+
+def get_quote_cache_stats() -> Dict[str, Any]:
+    """Estadísticas de la caché de cotizaciones"""
+    return quote_cache.stats()
+
 def get_crypto_price(symbol: str) -> Dict[str, Any]:
     """
     Obtiene el precio actual de una criptomoneda usando CoinGecko API
@@ -36,39 +117,9 @@ def get_crypto_price(symbol: str) -> Dict[str, Any]:
                 "supported_symbols": list(symbol_mapping.keys())
             }
         
-        # Obtener datos de CoinGecko
-        url = f"https://api.coingecko.com/api/v3/simple/price"
-        params = {
-            "ids": coin_id,
-            "vs_currencies": "usd,eur",
-            "include_24hr_change": "true",
-            "include_24hr_vol": "true",
-            "include_market_cap": "true"
-        }
-        
-        response = requests.get(url, params=params, timeout=10)
-        response.raise_for_status()
-        
-        data = response.json()
-        coin_data = data.get(coin_id, {})
-        
-        if not coin_data:
-            return {
-                "success": False,
-                "error": f"No se encontraron datos para {symbol}"
-            }
-        
-        return {
-            "success": True,
-            "symbol": symbol.upper(),
-            "price_usd": coin_data.get("usd"),
-            "price_eur": coin_data.get("eur"),
-            "change_24h": coin_data.get("usd_24h_change"),
-            "volume_24h": coin_data.get("usd_24h_vol"),
-            "market_cap": coin_data.get("usd_market_cap"),
-            "timestamp": datetime.now().isoformat(),
-            "source": "CoinGecko"
-        }
+        # Obtener datos de CoinGecko (compartidos entre requests)
+        quote = _cached_quote("coingecko", coin_id, lambda: _fetch_coingecko_prices([coin_id])[coin_id])
+        return _format_crypto_price(symbol, quote)
         
     except requests.exceptions.RequestException as e:
         logger.error(f"Error obteniendo precio de {symbol}: {e}")
@@ -83,6 +134,28 @@ def get_crypto_price(symbol: str) -> Dict[str, Any]:
             "error": f"Error inesperado: {str(e)}"
         }
 
+def _format_crypto_price(symbol: str, quote: Dict[str, Any]) -> Dict[str, Any]:
+    """Respuesta de get_crypto_price a partir de una cotización de CoinGecko"""
+    coin_data = quote["data"]
+    
+    if not coin_data:
+        return {
+            "success": False,
+            "error": f"No se encontraron datos para {symbol}"
+        }
+    
+    return {
+        "success": True,
+        "symbol": symbol.upper(),
+        "price_usd": coin_data.get("usd"),
+        "price_eur": coin_data.get("eur"),
+        "change_24h": coin_data.get("usd_24h_change"),
+        "volume_24h": coin_data.get("usd_24h_vol"),
+        "market_cap": coin_data.get("usd_market_cap"),
+        "timestamp": quote["fetched_at"],
+        "source": "CoinGecko"
+    }
+
 def get_forex_price(pair: str) -> Dict[str, Any]:
     """
     Obtiene el precio actual de un par de divisas usando una API gratuita
@@ -98,20 +171,17 @@ def get_forex_price(pair: str) -> Dict[str, Any]:
         base_currency = pair.split('/')[0]
         target_currency = pair.split('/')[1]
         
-        url = f"https://api.exchangerate-api.com/v4/latest/{base_currency}"
-        
-        response = requests.get(url, timeout=10)
-        response.raise_for_status()
+        # Todas las tasas de la moneda base se cachean juntas
+        quote = _cached_quote("exchangerate", base_currency, lambda: _fetch_exchange_rates(base_currency))
+        rates = quote["rates"]
         
-        data = response.json()
-        
-        if target_currency not in data.get("rates", {}):
+        if target_currency not in rates:
             return {
                 "success": False,
                 "error": f"Par de divisas no soportado: {pair}"
             }
         
-        rate = data["rates"][target_currency]
+        rate = rates[target_currency]
         
         return {
             "success": True,
@@ -119,7 +189,7 @@ def get_forex_price(pair: str) -> Dict[str, Any]:
             "rate": rate,
             "base_currency": base_currency,
             "target_currency": target_currency,
-            "timestamp": datetime.now().isoformat(),
+            "timestamp": quote["fetched_at"],
             "source": "ExchangeRate-API"
         }
         
@@ -136,6 +206,78 @@ def get_forex_price(pair: str) -> Dict[str, Any]:
             "error": f"Error inesperado: {str(e)}"
         }
 
+def get_prices(symbols: List[str]) -> Dict[str, Any]:
+    """
+    Obtiene los precios de varias criptomonedas y/o pares de divisas.
+    Todas las criptomonedas se piden a CoinGecko en una sola llamada y los
+    pares de divisas comparten una llamada por moneda base.
+    
+    Args:
+        symbols: Lista de símbolos (ej: ["BTC", "ETH", "EUR/USD", "EUR/GBP"])
+    
+    Returns:
+        Dict con la lista de precios en el mismo orden pedido
+    """
+    try:
+        from config.assistant_config import SUPPORTED_CRYPTO
+        
+        symbols = [str(symbol).strip() for symbol in symbols if str(symbol).strip()]
+        if len(symbols) > MAX_SYMBOLS_PER_REQUEST:
+            return {
+                "success": False,
+                "error": f"Máximo {MAX_SYMBOLS_PER_REQUEST} símbolos por consulta"
+            }
+        
+        # Una sola llamada a CoinGecko para todas las criptomonedas
+        coin_ids = [SUPPORTED_CRYPTO[symbol.upper()] for symbol in symbols if symbol.upper() in SUPPORTED_CRYPTO]
+        batch_error = None
+        if coin_ids:
+            try:
+                _prefetch_crypto_quotes(coin_ids)
+            except requests.exceptions.RequestException as e:
+                # Sin pedidos por símbolo: con la API ya limitando solo multiplicarían las llamadas
+                logger.error(f"Error obteniendo precios en lote de CoinGecko: {e}")
+                batch_error = e
+        
+        prices = []
+        for symbol in symbols:
+            if '/' in symbol:
+                # Los pares con la misma base reutilizan la tabla de tasas cacheada
+                prices.append(get_forex_price(symbol.upper()))
+            elif batch_error is not None and symbol.upper() in SUPPORTED_CRYPTO:
+                prices.append(_stale_crypto_price(symbol, SUPPORTED_CRYPTO[symbol.upper()], batch_error))
+            else:
+                prices.append(get_crypto_price(symbol))
+        
+        return {
+            "success": any(price["success"] for price in prices),
+            "prices": prices,
+            "timestamp": datetime.now().isoformat()
+        }
+        
+    except Exception as e:
+        logger.error(f"Error inesperado obteniendo precios de {symbols}: {e}")
+        return {
+            "success": False,
+            "error": f"Error inesperado: {str(e)}"
+        }
+
+def _stale_crypto_price(symbol: str, coin_id: str, error: Exception) -> Dict[str, Any]:
+    """Cotización vieja (dentro de stale_ttl) cuando falló la consulta en lote, o el error"""
+    quote = quote_cache.get(("coingecko", coin_id))
+    if quote is not None:
+        # No era parte de la consulta que falló
+        return _format_crypto_price(symbol, quote)
+    
+    quote = quote_cache.get_stale(("coingecko", coin_id))
+    if quote is not None:
+        return {**_format_crypto_price(symbol, quote), "stale": True}
+    
+    return {
+        "success": False,
+        "error": f"Error de conexión: {str(error)}"
+    }
+
 def analyze_image(image_url: str, analysis_type: str = "complete") -> Dict[str, Any]:
     """
     Analiza una imagen de gráfico de trading usando GPT-4o con visión
@@ -211,37 +353,66 @@ def analyze_image(image_url: str, analysis_type: str = "complete") -> Dict[str,
             """
         }
         
-        prompt = analysis_prompts.get(analysis_type, analysis_prompts["complete"])
+        if analysis_type not in analysis_prompts:
+            analysis_type = "complete"
+        prompt = analysis_prompts[analysis_type]
         
-        # Realizar el análisis con GPT-4o
-        response = openai_client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {
-                    "role": "system",
-                    "content": "Eres un experto analista técnico de trading con más de 15 años de experiencia. Analiza gráficos de manera profesional, objetiva y educativa. Siempre incluye advertencias de riesgo."
-                },
-                {
-                    "role": "user",
-                    "content": [
-                        {"type": "text", "text": prompt},
-                        {"type": "image_url", "image_url": {"url": image_url}}
-                    ]
-                }
-            ],
-            max_tokens=2000,
-            temperature=0.3
-        )
+        namespace = (analysis_type, IMAGE_ANALYSIS_CONFIG["prompt_version"])
         
-        analysis = response.choices[0].message.content
+        def run_analysis():
+            content = load_image_bytes(image_url)
+            
+            # Gráfico casi igual a uno analizado hace poco: reutilizar ese análisis
+            phash = dhash(content, IMAGE_ANALYSIS_CONFIG["near_duplicate_hash_size"]) if content is not None and near_duplicates.enabled else None
+            if phash is not None:
+                match = near_duplicates.find(phash, namespace, IMAGE_ANALYSIS_CONFIG["near_duplicate_max_distance"])
+                if match:
+                    previous, distance = match
+                    logger.info(f"Análisis reutilizado de una imagen casi igual (distancia {distance})")
+                    return {**previous, "near_duplicate": True}
+            
+            # Reducir la imagen antes de enviarla (menos tokens de visión)
+            vision_url, detail = prepare_vision_image(image_url, content)
+            
+            # Realizar el análisis con GPT-4o
+            response = openai_client.chat.completions.create(
+                model="gpt-4o",
+                messages=[
+                    {
+                        "role": "system",
+                        "content": "Eres un experto analista técnico de trading con más de 15 años de experiencia. Analiza gráficos de manera profesional, objetiva y educativa. Siempre incluye advertencias de riesgo."
+                    },
+                    {
+                        "role": "user",
+                        "content": [
+                            {"type": "text", "text": prompt},
+                            {"type": "image_url", "image_url": {"url": vision_url, "detail": detail}}
+                        ]
+                    }
+                ],
+                max_tokens=2000,
+                temperature=0.3
+            )
+            
+            result = {
+                "success": True,
+                "analysis": response.choices[0].message.content,
+                "analysis_type": analysis_type,
+                "timestamp": datetime.now().isoformat(),
+                "model": "gpt-4o"
+            }
+            if phash is not None:
+                near_duplicates.add(phash, namespace, result)
+            return result
+        
+        # Mismo gráfico y mismo tipo de análisis: reutilizar el resultado
+        cache_key = analysis_cache_key(image_url, *namespace)
+        result, cached = analysis_cache.get_or_compute(cache_key, run_analysis)
         
         return {
-            "success": True,
-            "analysis": analysis,
-            "analysis_type": analysis_type,
+            **result,
             "image_url": image_url,
-            "timestamp": datetime.now().isoformat(),
-            "model": "gpt-4o"
+            "cached": cached or result.get("near_duplicate", False)
         }
         
     except Exception as e:
@@ -342,6 +513,12 @@ def execute_function(function_name: str, arguments: Dict[str, Any]) -> Dict[str,
                 return {"success": False, "error": "Par de divisas requerido"}
             return get_forex_price(pair)
             
+        elif function_name == "get_prices":
+            symbols = arguments.get("symbols")
+            if not symbols or not isinstance(symbols, list):
+                return {"success": False, "error": "Lista de símbolos requerida"}
+            return get_prices(symbols)
+            
         elif function_name == "analyze_image":
             image_url = arguments.get("image_url")
             analysis_type = arguments.get("analysis_type", "complete")
@@ -365,6 +542,7 @@ def execute_function(function_name: str, arguments: Dict[str, Any]) -> Dict[str,
                 "available_functions": [
                     "get_crypto_price",
                     "get_forex_price", 
+                    "get_prices",
                     "analyze_image",
                     "get_market_sentiment",
                     "get_economic_calendar"
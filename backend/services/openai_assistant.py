@@ -1,8 +1,11 @@
 import os
 import json
 import time
-from openai import OpenAI
-from typing import Optional, List, Dict, Any
+import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from openai import OpenAI, NotFoundError
+from typing import Optional, List, Dict, Any, Iterator, BinaryIO
 from datetime import datetime
 import logging
 
@@ -15,13 +18,30 @@ class OpenAIAssistant:
         self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
         
         # Cargar configuración del assistant
-        from config.assistant_config import ASSISTANT_ID, ASSISTANT_CONFIG
+        from config.assistant_config import ASSISTANT_ID, ASSISTANT_CONFIG, JOB_CONFIG, TOOL_EXECUTION_CONFIG, THREAD_CONFIG
         
         self.assistant_id = ASSISTANT_ID
         self.assistant_name = ASSISTANT_CONFIG["name"]
         self.model = ASSISTANT_CONFIG["model"]
         self.instructions = self._load_instructions()
         self.tools = self._load_tools()
+        self.thread_config = THREAD_CONFIG
+        
+        # Executor para jobs en segundo plano (la concurrencia la acota el executor, no los workers WSGI)
+        self.job_config = JOB_CONFIG
+        self._job_executor = ThreadPoolExecutor(
+            max_workers=JOB_CONFIG["max_workers"],
+            thread_name_prefix="assistant-job"
+        )
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._jobs_lock = threading.Lock()
+        
+        # Executor propio para tool calls (separado del de jobs para no bloquearse entre sí)
+        self.tool_config = TOOL_EXECUTION_CONFIG
+        self._tool_executor = ThreadPoolExecutor(
+            max_workers=TOOL_EXECUTION_CONFIG["max_workers"],
+            thread_name_prefix="assistant-tool"
+        )
         
         # Verificar que el assistant existe y configurarlo
         self._verify_and_setup_assistant()
@@ -103,6 +123,7 @@ Siempre incluir:
 Puedes usar las siguientes funciones para obtener información en tiempo real:
 - `get_crypto_price`: Obtener precios actuales de criptomonedas
 - `get_forex_price`: Obtener precios actuales de pares de divisas
+- `get_prices`: Obtener en una sola llamada los precios de varias criptomonedas y/o pares (úsala cuando el usuario pregunte por más de un activo)
 - `analyze_image`: Analizar imágenes de gráficos subidas por el usuario
 
 ## **INSTRUCCIONES ESPECÍFICAS**
@@ -116,6 +137,8 @@ Puedes usar las siguientes funciones para obtener información en tiempo real:
     
     def _load_tools(self) -> List[Dict[str, Any]]:
         """Define las herramientas/funciones disponibles para el assistant"""
+        from config.assistant_config import SUPPORTED_CRYPTO, SUPPORTED_FOREX
+        
         return [
             {
                 "type": "function",
@@ -153,6 +176,28 @@ Puedes usar las siguientes funciones para obtener información en tiempo real:
                     }
                 }
             },
+            {
+                "type": "function",
+                "function": {
+                    "name": "get_prices",
+                    "description": "Obtiene en una sola llamada los precios actuales de varias criptomonedas y/o pares de divisas",
+                    "parameters": {
+                        "type": "object",
+                        "properties": {
+                            "symbols": {
+                                "type": "array",
+                                "description": "Símbolos de criptomonedas (ej: BTC, ETH) y/o pares de divisas (ej: EUR/USD)",
+                                "items": {
+                                    "type": "string",
+                                    "enum": list(SUPPORTED_CRYPTO.keys()) + SUPPORTED_FOREX
+                                },
+                                "maxItems": 20
+                            }
+                        },
+                        "required": ["symbols"]
+                    }
+                }
+            },
             {
                 "type": "function",
                 "function": {
@@ -233,25 +278,42 @@ Puedes usar las siguientes funciones para obtener información en tiempo real:
             logger.error(f"Error creando thread: {e}")
             raise
     
-    def send_message(self, thread_id: str, message: str, file_ids: Optional[List[str]] = None) -> Dict[str, Any]:
-        """Envía un mensaje al thread y obtiene la respuesta"""
+    def _create_user_message(self, thread_id: str, message: str, file_ids: Optional[List[str]] = None,
+                             image_urls: Optional[List[str]] = None):
+        """Agrega el mensaje del usuario al thread"""
+        params = {
+            "thread_id": thread_id,
+            "role": "user",
+            "content": message
+        }
+        
+        if image_urls:
+            # Imágenes como partes del contenido: el modelo las ve directamente
+            content = [{"type": "text", "text": message}] if message else []
+            content += [{"type": "image_url", "image_url": {"url": url}} for url in image_urls]
+            params["content"] = content
+        
+        if file_ids:
+            # Si hay archivos, crear el mensaje con attachments
+            params["attachments"] = [{"file_id": file_id, "tools": [{"type": "file_search"}]} for file_id in file_ids]
+        
+        self.client.beta.threads.messages.create(**params)
+    
+    def send_message(self, thread_id: str, message: str, file_ids: Optional[List[str]] = None,
+                     image_urls: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Envía un mensaje (con archivos o URLs de imágenes opcionales) al thread y obtiene la respuesta"""
         try:
             # Crear el mensaje
-            if file_ids:
-                # Si hay archivos, crear el mensaje con attachments
-                self.client.beta.threads.messages.create(
-                    thread_id=thread_id,
-                    role="user",
-                    content=message,
-                    attachments=[{"file_id": file_id, "tools": [{"type": "file_search"}]} for file_id in file_ids]
-                )
-            else:
-                # Mensaje sin archivos
-                self.client.beta.threads.messages.create(
-                    thread_id=thread_id,
-                    role="user",
-                    content=message
-                )
+            try:
+                self._create_user_message(thread_id, message, file_ids, image_urls)
+            except NotFoundError as e:
+                # El thread ya no existe en OpenAI: quien llama decide si recrearlo
+                logger.warning(f"Thread {thread_id} no encontrado: {e}")
+                return {
+                    "success": False,
+                    "error": f"Thread no encontrado: {thread_id}",
+                    "thread_not_found": True
+                }
             
             # Ejecutar el run
             run = self.client.beta.threads.runs.create(
@@ -286,8 +348,80 @@ Puedes usar las siguientes funciones para obtener información en tiempo real:
                 "error": str(e)
             }
     
-    def _wait_for_run_completion(self, thread_id: str, run_id: str, timeout: int = 60) -> Any:
-        """Espera a que el run se complete"""
+    def stream_message(self, thread_id: str, message: str, file_ids: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+        """
+        Variante en streaming de send_message. Genera eventos a medida que
+        llegan del run:
+        - {"type": "delta", "text": ...} por cada fragmento de texto
+        - {"type": "tool_calls", "functions": [...]} cuando el run pide funciones
+        - {"type": "done", "message": ..., "run_id": ...} al completar
+        - {"type": "error", "error": ...} si falla (con "thread_not_found" si el thread no existe)
+        """
+        try:
+            self._create_user_message(thread_id, message, file_ids)
+        except NotFoundError as e:
+            logger.warning(f"Thread {thread_id} no encontrado: {e}")
+            yield {"type": "error", "error": f"Thread no encontrado: {thread_id}", "thread_not_found": True}
+            return
+        except Exception as e:
+            logger.error(f"Error enviando mensaje: {e}")
+            yield {"type": "error", "error": str(e)}
+            return
+        
+        try:
+            stream = self.client.beta.threads.runs.create(
+                thread_id=thread_id,
+                assistant_id=self.assistant_id,
+                stream=True
+            )
+            run_id = None
+            chunks = []
+            
+            # Cada submit_tool_outputs abre un nuevo stream que continúa el mismo run
+            while stream is not None:
+                next_stream = None
+                with stream:
+                    for event in stream:
+                        if event.event == "thread.run.created":
+                            run_id = event.data.id
+                        
+                        elif event.event == "thread.message.delta":
+                            for block in event.data.delta.content or []:
+                                if block.type == "text" and block.text and block.text.value:
+                                    chunks.append(block.text.value)
+                                    yield {"type": "delta", "text": block.text.value}
+                        
+                        elif event.event == "thread.run.requires_action":
+                            run = event.data
+                            tool_calls = run.required_action.submit_tool_outputs.tool_calls
+                            yield {"type": "tool_calls", "functions": [tc.function.name for tc in tool_calls]}
+                            
+                            next_stream = self.client.beta.threads.runs.submit_tool_outputs(
+                                thread_id=thread_id,
+                                run_id=run.id,
+                                tool_outputs=self._run_tool_calls(tool_calls),
+                                stream=True
+                            )
+                        
+                        elif event.event in ("thread.run.failed", "thread.run.cancelled", "thread.run.expired"):
+                            yield {"type": "error", "error": f"Run falló con status: {event.data.status}", "run_id": run_id}
+                            return
+                        
+                        elif event.event == "error":
+                            yield {"type": "error", "error": str(event.data), "run_id": run_id}
+                            return
+                
+                stream = next_stream
+            
+            yield {"type": "done", "message": "".join(chunks), "run_id": run_id}
+            
+        except Exception as e:
+            logger.error(f"Error en streaming del mensaje: {e}")
+            yield {"type": "error", "error": str(e)}
+    
+    def _wait_for_run_completion(self, thread_id: str, run_id: str, timeout: Optional[int] = None) -> Any:
+        """Espera a que el run se complete (por defecto hasta `thread_timeout_seconds`)"""
+        timeout = timeout or self.thread_config["thread_timeout_seconds"]
         start_time = time.time()
         
         while time.time() - start_time < timeout:
@@ -309,25 +443,56 @@ Puedes usar las siguientes funciones para obtener información en tiempo real:
         
         raise TimeoutError("Run no completó en el tiempo especificado")
     
+    def _run_tool_calls(self, tool_calls: List[Any]) -> List[Dict[str, str]]:
+        """
+        Ejecuta en paralelo las funciones pedidas por el assistant y arma los
+        tool_outputs en el mismo orden. Cada llamada tiene su propio plazo;
+        si lo excede se informa el timeout como resultado de esa función.
+        """
+        from .functions import execute_function
+        
+        start_time = time.time()
+        pending = []
+        for tool_call in tool_calls:
+            function_name = tool_call.function.name
+            try:
+                arguments = json.loads(tool_call.function.arguments)
+            except json.JSONDecodeError as e:
+                arguments = None
+                logger.error(f"Argumentos inválidos para {function_name}: {e}")
+            
+            future = None
+            if arguments is not None:
+                # Ejecutar la función correspondiente
+                future = self._tool_executor.submit(execute_function, function_name, arguments)
+            
+            timeout = self.tool_config["timeouts"].get(function_name, self.tool_config["default_timeout_seconds"])
+            pending.append((tool_call, future, start_time + timeout))
+        
+        tool_outputs = []
+        for tool_call, future, deadline in pending:
+            if future is None:
+                result = {"success": False, "error": "Argumentos inválidos"}
+            else:
+                try:
+                    result = future.result(timeout=max(0, deadline - time.time()))
+                except FutureTimeoutError:
+                    logger.warning(f"Timeout ejecutando {tool_call.function.name}")
+                    result = {"success": False, "error": "Tiempo de espera agotado"}
+            
+            tool_outputs.append({
+                "tool_call_id": tool_call.id,
+                "output": json.dumps(result)
+            })
+        
+        return tool_outputs
+    
     def _handle_required_action(self, thread_id: str, run: Any) -> Any:
         """Maneja las acciones requeridas por el assistant (llamadas a funciones)"""
         try:
             if run.required_action and run.required_action.type == "submit_tool_outputs":
                 tool_calls = run.required_action.submit_tool_outputs.tool_calls
-                tool_outputs = []
-                
-                for tool_call in tool_calls:
-                    function_name = tool_call.function.name
-                    arguments = json.loads(tool_call.function.arguments)
-                    
-                    # Ejecutar la función correspondiente
-                    from .functions import execute_function
-                    result = execute_function(function_name, arguments)
-                    
-                    tool_outputs.append({
-                        "tool_call_id": tool_call.id,
-                        "output": json.dumps(result)
-                    })
+                tool_outputs = self._run_tool_calls(tool_calls)
                 
                 # Enviar los resultados
                 run = self.client.beta.threads.runs.submit_tool_outputs(
@@ -342,14 +507,13 @@ Puedes usar las siguientes funciones para obtener información en tiempo real:
             logger.error(f"Error manejando acción requerida: {e}")
             raise
     
-    def upload_file(self, file_path: str) -> str:
-        """Sube un archivo y retorna el file_id"""
+    def upload_file(self, file: BinaryIO, filename: str) -> str:
+        """Sube un archivo (objeto abierto en modo binario) y retorna el file_id"""
         try:
-            with open(file_path, "rb") as file:
-                uploaded_file = self.client.files.create(
-                    file=file,
-                    purpose="assistants"
-                )
+            uploaded_file = self.client.files.create(
+                file=(filename, file),
+                purpose="assistants"
+            )
             
             # En la nueva API, los archivos se asocian automáticamente con el assistant
             # cuando se usan en un mensaje, no necesitamos asociarlos manualmente
@@ -361,13 +525,37 @@ Puedes usar las siguientes funciones para obtener información en tiempo real:
             logger.error(f"Error subiendo archivo: {e}")
             raise
     
+    def delete_file(self, file_id: str) -> bool:
+        """Elimina un archivo subido"""
+        try:
+            self.client.files.delete(file_id)
+            logger.info(f"Archivo eliminado: {file_id}")
+            return True
+        except NotFoundError:
+            return True
+        except Exception as e:
+            logger.error(f"Error eliminando archivo {file_id}: {e}")
+            return False
+    
     def get_thread_messages(self, thread_id: str, limit: int = 10) -> List[Dict[str, Any]]:
         """Obtiene los mensajes de un thread"""
+        return self.get_thread_messages_page(thread_id, limit=limit)["messages"]
+    
+    def get_thread_messages_page(self, thread_id: str, limit: int = 10, after: Optional[str] = None,
+                                 before: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Obtiene una página de mensajes del thread, del más reciente al más antiguo.
+        `after` (id de mensaje) pide la página siguiente (más antigua) y
+        `before` la anterior (más nueva).
+        """
         try:
-            messages = self.client.beta.threads.messages.list(
-                thread_id=thread_id,
-                limit=limit
-            )
+            params = {"thread_id": thread_id, "limit": limit}
+            if after:
+                params["after"] = after
+            if before:
+                params["before"] = before
+            
+            messages = self.client.beta.threads.messages.list(**params)
             
             formatted_messages = []
             for msg in messages.data:
@@ -381,18 +569,97 @@ Puedes usar las siguientes funciones para obtener información en tiempo real:
                     else:
                         content = str(msg.content[0])
                 
-                formatted_messages.append({
+                formatted = {
                     "id": msg.id,
                     "role": msg.role,
                     "content": content,
                     "created_at": msg.created_at
-                })
+                }
+                if (getattr(msg, "metadata", None) or {}).get("compaction_summary"):
+                    # Resumen sembrado por compact_thread, no lo escribió el usuario
+                    formatted["compaction_summary"] = True
+                formatted_messages.append(formatted)
             
-            return formatted_messages
+            has_more = getattr(messages, "has_more", None)
+            if has_more is None:
+                has_more = len(messages.data) >= limit
+            
+            return {
+                "messages": formatted_messages,
+                "has_more": bool(has_more),
+                "first_id": formatted_messages[0]["id"] if formatted_messages else None,
+                "last_id": formatted_messages[-1]["id"] if formatted_messages else None
+            }
             
         except Exception as e:
             logger.error(f"Error obteniendo mensajes: {e}")
-            return []
+            return {"messages": [], "has_more": False, "first_id": None, "last_id": None}
+    
+    def compact_thread(self, thread_id: str) -> Optional[Dict[str, Any]]:
+        """
+        Si el thread supera `max_messages_per_thread`, resume los mensajes
+        viejos y crea un thread nuevo con el resumen y los últimos mensajes.
+        Retorna {"thread_id": nuevo, "last_message_id": último mensaje
+        incluido} o None si no hacía falta. No borra el thread viejo: quien
+        llama decide si el cambio se concreta.
+        """
+        config = self.thread_config
+        max_messages = config["max_messages_per_thread"]
+        
+        page = self.get_thread_messages_page(thread_id, limit=min(max_messages + 1, 100))
+        messages = page["messages"]
+        if len(messages) <= max_messages:
+            return None
+        
+        while page["has_more"] and len(messages) < config["compaction_max_messages"]:
+            page = self.get_thread_messages_page(thread_id, limit=100, after=page["last_id"])
+            messages.extend(page["messages"])
+        
+        # Orden cronológico: lo viejo se resume, lo reciente se copia
+        messages.reverse()
+        keep = config["compaction_keep_messages"]
+        older, recent = messages[:-keep], messages[-keep:]
+        
+        summary = self._summarize_messages(older)
+        seed = [{
+            "role": "user",
+            "content": f"Contexto: resumen de nuestra conversación anterior.\n\n{summary}",
+            # Marca para no mostrarlo en el historial (ver get_thread_messages_page)
+            "metadata": {"compaction_summary": "true"}
+        }]
+        seed += [
+            {"role": msg["role"], "content": msg["content"],
+             **({"metadata": {"compaction_summary": "true"}} if msg.get("compaction_summary") else {})}
+            for msg in recent if msg["content"]
+        ]
+        
+        thread = self.client.beta.threads.create(messages=seed)
+        logger.info(f"Thread {thread_id} compactado en {thread.id} ({len(older)} mensajes resumidos)")
+        return {
+            "thread_id": thread.id,
+            "last_message_id": messages[-1]["id"]
+        }
+    
+    def _summarize_messages(self, messages: List[Dict[str, Any]]) -> str:
+        """Resume una conversación para sembrar un thread nuevo"""
+        transcript = "\n\n".join(
+            f"{'Usuario' if msg['role'] == 'user' else 'Assistant'}: {msg['content'][:1500]}"
+            for msg in messages if msg["content"]
+        )
+        
+        response = self.client.chat.completions.create(
+            model=self.thread_config["compaction_summary_model"],
+            messages=[
+                {
+                    "role": "system",
+                    "content": "Resume la conversación entre un trader y su mentor de trading. Conserva activos, niveles de precio, operaciones abiertas o planeadas, preferencias del usuario y conclusiones. Sé conciso y usa viñetas."
+                },
+                {"role": "user", "content": transcript}
+            ],
+            max_tokens=self.thread_config["compaction_summary_max_tokens"],
+            temperature=0.2
+        )
+        return response.choices[0].message.content
     
     def delete_thread(self, thread_id: str) -> bool:
         """Elimina un thread"""
@@ -404,5 +671,79 @@ Puedes usar las siguientes funciones para obtener información en tiempo real:
             logger.error(f"Error eliminando thread: {e}")
             return False
 
+    def submit_job(self, func, owner: Optional[str] = None, job_id: Optional[str] = None) -> str:
+        """
+        Encola `func` (que retorna un dict de resultado) en el executor de
+        jobs y retorna el job_id de inmediato (se genera uno si no se indica).
+        Lanza RuntimeError si ya hay demasiados jobs pendientes.
+        """
+        self._prune_jobs()
+        
+        with self._jobs_lock:
+            pending = sum(1 for job in self._jobs.values() if job["status"] in ("queued", "running"))
+            if pending >= self.job_config["max_pending_jobs"]:
+                raise RuntimeError("Demasiados jobs pendientes")
+            
+            job_id = job_id or f"job_{uuid.uuid4().hex}"
+            self._jobs[job_id] = {
+                "job_id": job_id,
+                "owner": owner,
+                "status": "queued",
+                "result": None,
+                "created_at": time.time(),
+                "finished_at": None,
+                "done": threading.Event()
+            }
+        
+        self._job_executor.submit(self._run_job, job_id, func)
+        logger.info(f"Job encolado: {job_id}")
+        return job_id
+    
+    def _run_job(self, job_id: str, func):
+        """Ejecuta un job y guarda su resultado"""
+        job = self._jobs.get(job_id)
+        if job is None:
+            return
+        
+        job["status"] = "running"
+        try:
+            result = func()
+            status = "completed" if result.get("success") else "failed"
+        except Exception as e:
+            logger.error(f"Error ejecutando job {job_id}: {e}")
+            result = {"success": False, "error": str(e)}
+            status = "failed"
+        
+        job["result"] = result
+        job["status"] = status
+        job["finished_at"] = time.time()
+        job["done"].set()
+    
+    def get_job(self, job_id: str, wait: float = 0) -> Optional[Dict[str, Any]]:
+        """
+        Retorna el estado del job (sin el evento interno). Si `wait` > 0 y el
+        job no terminó, espera hasta `wait` segundos (long-poll).
+        Retorna None si el job no existe en este proceso.
+        """
+        job = self._jobs.get(job_id)
+        if job is None:
+            return None
+        
+        if wait > 0:
+            job["done"].wait(timeout=min(wait, self.job_config["max_wait_seconds"]))
+        
+        return {key: value for key, value in job.items() if key != "done"}
+    
+    def _prune_jobs(self):
+        """Descarta los jobs terminados hace más de result_ttl_seconds"""
+        cutoff = time.time() - self.job_config["result_ttl_seconds"]
+        with self._jobs_lock:
+            expired = [
+                job_id for job_id, job in self._jobs.items()
+                if job["finished_at"] is not None and job["finished_at"] < cutoff
+            ]
+            for job_id in expired:
+                del self._jobs[job_id]
+
 # Instancia global del assistant
 assistant_manager = OpenAIAssistant() 
\ No newline at end of file
@@ -0,0 +1,300 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Optional, List, Dict, Any, Iterator
+import logging
+import threading
+
+from firebase_admin import firestore
+
+from firebase_config import get_user_context, update_cached_user_context, db
+from config.assistant_config import THREAD_CONFIG
+from services.openai_assistant import assistant_manager
+from utils.cache import TTLCache
+
+# Configurar logging
+logger = logging.getLogger(__name__)
+
+# Caché uid -> thread_id. Se confía en el thread guardado; solo se
+# recrea cuando OpenAI responde que ya no existe (ver send_user_message).
+_thread_cache = TTLCache(
+    max_entries=THREAD_CONFIG["thread_cache_max_entries"],
+    default_ttl=THREAD_CONFIG["thread_cache_ttl_seconds"]
+)
+
+# Caché thread_id -> conversation_id. La conversación (chats/{uid}/conversations/{id})
+# nace con el thread y se conserva cuando la compactación lo reemplaza.
+_conversation_cache = TTLCache(
+    max_entries=THREAD_CONFIG["thread_cache_max_entries"],
+    default_ttl=THREAD_CONFIG["thread_cache_ttl_seconds"]
+)
+
+# Reemplazos de thread por compactación, escuchados por todos los workers
+THREAD_CHANGES_COLLECTION = 'thread_changes'
+
+# Compactación de threads en segundo plano (un thread a la vez por proceso)
+_compaction_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="thread-compaction")
+_compacting = set()
+_compacting_lock = threading.Lock()
+
+def get_user_thread_id(user_id: str) -> str:
+    """
+    Obtiene el thread_id del usuario (caché, Firestore) o crea uno nuevo
+    """
+    thread_id = _thread_cache.get(user_id)
+    if thread_id:
+        return thread_id
+
+    try:
+        thread_id = get_user_context(user_id).thread_id
+        if thread_id:
+            _thread_cache.set(user_id, thread_id)
+            return thread_id
+    except Exception as e:
+        logger.error(f"Error obteniendo thread_id para usuario {user_id}: {e}")
+
+    return create_user_thread(user_id)
+
+def set_user_thread_id(user_id: str, thread_id: str):
+    """
+    Guarda un thread nuevo del usuario en Firestore y en la caché. Un
+    thread nuevo empieza también una conversación nueva en el historial.
+    """
+    update_data = {
+        'thread_id': thread_id,
+        'conversation_id': thread_id,
+        'fechaActualizacion': datetime.now()
+    }
+    db.collection('users').document(user_id).update(update_data)
+    update_cached_user_context(user_id, update_data)
+    _thread_cache.set(user_id, thread_id)
+    _conversation_cache.set(thread_id, thread_id)
+
+def get_conversation_id(user_id: str, thread_id: str) -> str:
+    """
+    Id de la conversación del historial a la que pertenece el thread. Es
+    estable entre compactaciones; los usuarios anteriores a este campo
+    usan el thread_id.
+    """
+    conversation_id = _conversation_cache.get(thread_id)
+    if conversation_id:
+        return conversation_id
+
+    try:
+        data = get_user_context(user_id).data
+        if data.get('thread_id') != thread_id:
+            # Contexto de la request desactualizado (por ejemplo, el thread se reemplazó)
+            user_doc = db.collection('users').document(user_id).get()
+            data = user_doc.to_dict() if user_doc.exists else {}
+        if data.get('thread_id') == thread_id:
+            conversation_id = data.get('conversation_id')
+    except Exception as e:
+        logger.error(f"Error obteniendo conversation_id para usuario {user_id}: {e}")
+
+    conversation_id = conversation_id or thread_id
+    _conversation_cache.set(thread_id, conversation_id)
+    return conversation_id
+
+def create_user_thread(user_id: str) -> str:
+    """Crea un thread nuevo para el usuario y lo guarda"""
+    thread_id = assistant_manager.get_or_create_thread(user_id)
+
+    try:
+        set_user_thread_id(user_id, thread_id)
+        logger.info(f"Nuevo thread creado y guardado para usuario {user_id}: {thread_id}")
+    except Exception as e:
+        # Fallback: usar el thread aunque no se haya podido guardar en Firebase
+        logger.error(f"Error guardando thread_id para usuario {user_id}: {e}")
+
+    return thread_id
+
+def invalidate_user_thread(user_id: str):
+    """Descarta el thread_id cacheado del usuario"""
+    _thread_cache.invalidate(user_id)
+
+def replace_missing_thread(user_id: str, missing_thread_id: str) -> str:
+    """
+    Thread a usar cuando `missing_thread_id` ya no existe en OpenAI: el
+    guardado en Firestore si es otro (por ejemplo, lo compactó otro
+    worker) o uno nuevo.
+    """
+    invalidate_user_thread(user_id)
+
+    try:
+        user_doc = db.collection('users').document(user_id).get()
+        thread_id = user_doc.to_dict().get('thread_id') if user_doc.exists else None
+        if thread_id and thread_id != missing_thread_id:
+            _thread_cache.set(user_id, thread_id)
+            return thread_id
+    except Exception as e:
+        logger.error(f"Error releyendo thread_id para usuario {user_id}: {e}")
+
+    logger.warning(f"Thread {missing_thread_id} no existe, creando uno nuevo")
+    return create_user_thread(user_id)
+
+def send_user_message(user_id: str, message: str, file_ids: Optional[List[str]] = None,
+                      image_urls: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    Envía un mensaje al thread del usuario. Si OpenAI indica que el thread
+    ya no existe, lo reemplaza (ver replace_missing_thread) y reintenta una vez.
+    El resultado incluye el `thread_id` efectivamente usado.
+    """
+    thread_id = get_user_thread_id(user_id)
+    result = assistant_manager.send_message(thread_id, message, file_ids, image_urls)
+
+    if result.get('thread_not_found'):
+        thread_id = replace_missing_thread(user_id, thread_id)
+        result = assistant_manager.send_message(thread_id, message, file_ids, image_urls)
+
+    result['thread_id'] = thread_id
+    if result['success']:
+        result['conversation_id'] = get_conversation_id(user_id, thread_id)
+        schedule_thread_compaction(user_id, thread_id)
+    return result
+
+def stream_user_message(user_id: str, message: str, file_ids: Optional[List[str]] = None) -> Iterator[Dict[str, Any]]:
+    """
+    Variante en streaming de send_user_message. Reenvía los eventos de
+    assistant_manager.stream_message; el evento "done" incluye el `thread_id`.
+    """
+    thread_id = get_user_thread_id(user_id)
+
+    for attempt in range(2):
+        retry = False
+        for event in assistant_manager.stream_message(thread_id, message, file_ids):
+            # El thread inexistente se detecta antes de cualquier delta
+            if event.get('thread_not_found') and attempt == 0:
+                thread_id = replace_missing_thread(user_id, thread_id)
+                retry = True
+                break
+
+            if event['type'] == 'done':
+                event['thread_id'] = thread_id
+                event['conversation_id'] = get_conversation_id(user_id, thread_id)
+                schedule_thread_compaction(user_id, thread_id)
+            yield event
+
+        if not retry:
+            return
+
+def schedule_thread_compaction(user_id: str, thread_id: str):
+    """Encola la compactación del thread si está habilitada y no está en curso"""
+    if not THREAD_CONFIG["compaction_enabled"]:
+        return
+
+    with _compacting_lock:
+        if thread_id in _compacting:
+            return
+        _compacting.add(thread_id)
+
+    def run():
+        try:
+            compact_user_thread(user_id, thread_id)
+        except Exception as e:
+            logger.error(f"Error compactando thread {thread_id} de usuario {user_id}: {e}")
+        finally:
+            with _compacting_lock:
+                _compacting.discard(thread_id)
+
+    _compaction_executor.submit(run)
+
+def compact_user_thread(user_id: str, thread_id: str) -> Optional[str]:
+    """
+    Reemplaza el thread del usuario por uno compactado (ver
+    assistant_manager.compact_thread). El cambio del thread_id guardado es
+    un compare-and-set: si mientras tanto el thread cambió o recibió
+    mensajes nuevos, se descarta el thread compactado.
+    Retorna el nuevo thread_id o None si no hubo cambio.
+    """
+    compacted = assistant_manager.compact_thread(thread_id)
+    if not compacted:
+        return None
+
+    new_thread_id = compacted['thread_id']
+    latest = assistant_manager.get_thread_messages_page(thread_id, limit=1)['first_id']
+    conversation_id = None
+    if latest == compacted['last_message_id']:
+        conversation_id = _swap_user_thread_id(user_id, thread_id, new_thread_id)
+    if not conversation_id:
+        logger.info(f"Compactación de {thread_id} descartada: el thread cambió mientras se resumía")
+        assistant_manager.delete_thread(new_thread_id)
+        return None
+
+    _thread_cache.set(user_id, new_thread_id)
+    _conversation_cache.set(new_thread_id, conversation_id)
+    _delete_thread_later(thread_id)
+    logger.info(f"Thread de usuario {user_id} reemplazado: {thread_id} -> {new_thread_id}")
+    return new_thread_id
+
+def _delete_thread_later(thread_id: str):
+    """
+    Borra el thread reemplazado tras `thread_timeout_seconds`: un run que
+    ya estaba en curso en ese thread (u otro worker con el thread_id aún
+    cacheado) alcanza a terminar en lugar de fallar con el thread borrado.
+    """
+    timer = threading.Timer(THREAD_CONFIG["thread_timeout_seconds"], assistant_manager.delete_thread, args=[thread_id])
+    timer.daemon = True
+    timer.start()
+
+def _swap_user_thread_id(user_id: str, expected_thread_id: str, new_thread_id: str) -> Optional[str]:
+    """
+    Cambia el thread_id guardado solo si sigue siendo `expected_thread_id`,
+    conservando la conversación. Retorna el conversation_id o None si no
+    hubo cambio.
+    """
+    user_ref = db.collection('users').document(user_id)
+
+    @firestore.transactional
+    def swap(transaction):
+        snapshot = user_ref.get(transaction=transaction)
+        data = snapshot.to_dict() if snapshot.exists else {}
+        if data.get('thread_id') != expected_thread_id:
+            return None
+        conversation_id = data.get('conversation_id') or expected_thread_id
+        transaction.update(user_ref, {
+            'thread_id': new_thread_id,
+            'conversation_id': conversation_id,
+            'fechaActualizacion': datetime.now()
+        })
+        now = datetime.now(timezone.utc)
+        transaction.set(db.collection(THREAD_CHANGES_COLLECTION).document(), {
+            'uid': user_id,
+            'thread_id': new_thread_id,
+            'previous_thread_id': expected_thread_id,
+            'changed_at': now,
+            # Campo para una política TTL de Firestore sobre la colección
+            'expires_at': now + timedelta(days=1)
+        })
+        return conversation_id
+
+    return swap(db.transaction())
+
+def start_thread_listener():
+    """
+    Inicia un listener sobre los reemplazos de thread registrados desde
+    ahora en `thread_changes` y descarta el thread_id cacheado de cada
+    usuario afectado (si todavía apunta al thread reemplazado).
+    Retorna el watch (o None si está desactivado en THREAD_CONFIG).
+    """
+    if not THREAD_CONFIG["use_snapshot_listener"]:
+        return None
+
+    def on_thread_changes(col_snapshot, changes, read_time):
+        for change in changes:
+            if change.type.name != 'ADDED':
+                continue
+            data = change.document.to_dict() or {}
+            if _thread_cache.get(data.get('uid')) == data.get('previous_thread_id'):
+                invalidate_user_thread(data.get('uid'))
+
+    try:
+        started_at = datetime.now(timezone.utc)
+        watch = (
+            db.collection(THREAD_CHANGES_COLLECTION)
+            .where('changed_at', '>', started_at)
+            .on_snapshot(on_thread_changes)
+        )
+        logger.info("Listener de threads iniciado")
+        return watch
+    except Exception as e:
+        logger.error(f"Error iniciando listener de threads: {e}")
+        return None
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""
+Cambia el rol de un usuario (por ejemplo, al pasar a premium).
+
+Usa firebase_config.set_user_role, que además avisa a los workers para que
+invaliden su caché de roles al instante.
+
+Uso:
+    python set_user_role.py <uid> <free|premium>
+"""
+
+import sys
+from dotenv import load_dotenv
+
+# Cargar variables de entorno
+load_dotenv()
+
+VALID_ROLES = ('free', 'premium')
+
+def main():
+    if len(sys.argv) != 3 or sys.argv[2] not in VALID_ROLES:
+        print(__doc__)
+        sys.exit(1)
+
+    from firebase_config import set_user_role
+
+    set_user_role(sys.argv[1], sys.argv[2])
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+Sincroniza el campo `users/{uid}.rol` con el custom claim de rol en Firebase Auth.
+
+Uso:
+    python sync_role_claims.py          # sincronización completa (una vez)
+    python sync_role_claims.py --watch  # sincroniza y queda escuchando cambios
+"""
+
+import sys
+import time
+from dotenv import load_dotenv
+
+# Cargar variables de entorno
+load_dotenv()
+
+def main():
+    from firebase_config import sync_all_role_claims, watch_role_claims
+
+    print("🔄 Sincronizando claims de rol...")
+    updated = sync_all_role_claims()
+    print(f"✅ Claims actualizados: {updated}")
+
+    if '--watch' in sys.argv:
+        watch = watch_role_claims()
+        print("👀 Escuchando cambios en `users`... (Ctrl+C para salir)")
+        try:
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            watch.unsubscribe()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+import base64
+import binascii
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+from config.assistant_config import IMAGE_ANALYSIS_CONFIG
+from utils.cache import LoadingCache
+
+# Configurar logging
+logger = logging.getLogger(__name__)
+
+
+def image_cache_key(image_url: str) -> str:
+    """
+    Identidad de una imagen para la caché: sha256 del contenido si es un
+    data URL, o la URL normalizada (host en minúsculas, sin fragmento y
+    con los parámetros ordenados) en otro caso.
+    """
+    if image_url.startswith('data:'):
+        payload = image_url.split(',', 1)[-1]
+        try:
+            content = base64.b64decode(payload, validate=False)
+        except (binascii.Error, ValueError):
+            content = payload.encode()
+        return 'sha256:' + hashlib.sha256(content).hexdigest()
+
+    parts = urlsplit(image_url.strip())
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return 'url:' + urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path, query, ''))
+
+
+def analysis_cache_key(image_url: str, *parts: Any) -> str:
+    """Clave de un análisis: imagen + tipo de análisis, versión de prompt, etc."""
+    raw = '|'.join([image_cache_key(image_url), *map(str, parts)])
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+class AnalysisCache:
+    """
+    Caché de resultados de análisis de imágenes.
+
+    - Memoria: LRU con TTL y single-flight (un mismo gráfico pedido a la
+      vez dispara un solo análisis).
+    - Disco (opcional): un JSON por clave en `disk_dir`, compartido entre
+      workers y reinicios. Se acota a `disk_max_entries` archivos.
+
+    Solo se cachean valores JSON serializables y análisis exitosos: si
+    `compute` lanza una excepción no se guarda nada.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, disk_dir: Optional[str] = None,
+                 disk_max_entries: int = 5000, enabled: bool = True):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self.disk_max_entries = disk_max_entries
+        self._memory = LoadingCache(max_entries=max_entries)
+        self._disk_lock = threading.Lock()
+        self._disk_writes = 0
+        self.disk_hits = 0
+
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def get_or_compute(self, key: str, compute: Callable[[], Any]) -> Tuple[Any, bool]:
+        """Retorna (valor, vino_de_caché)"""
+        if not self.enabled:
+            return compute(), False
+
+        computed = []
+
+        def load():
+            value = self._disk_get(key)
+            if value is not None:
+                return value
+            value = compute()
+            computed.append(True)
+            self._disk_set(key, value)
+            return value
+
+        value = self._memory.get_or_load(key, load, ttl=self.ttl)
+        return value, not computed
+
+    def invalidate(self, key: str):
+        self._memory.invalidate(key)
+        if self.disk_dir:
+            try:
+                os.remove(self._disk_path(key))
+            except FileNotFoundError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        """Contadores para monitoreo"""
+        stats = self._memory.stats()
+        stats['disk_enabled'] = bool(self.disk_dir)
+        stats['disk_hits'] = self.disk_hits
+        return stats
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _disk_get(self, key: str) -> Any:
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Entrada de caché de análisis ilegible {path}: {e}")
+            return None
+
+        if entry.get('expires_at', 0) <= time.time():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None
+
+        self.disk_hits += 1
+        return entry['value']
+
+    def _disk_set(self, key: str, value: Any):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({'expires_at': time.time() + self.ttl, 'value': value}, f, ensure_ascii=False)
+            # Reemplazo atómico: otro worker nunca lee un archivo a medio escribir
+            os.replace(tmp_path, path)
+        except (OSError, TypeError, ValueError) as e:
+            logger.warning(f"No se pudo guardar el análisis en disco: {e}")
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+            return
+
+        with self._disk_lock:
+            self._disk_writes += 1
+            prune = self._disk_writes % 100 == 0
+        if prune:
+            self._prune_disk()
+
+    def _prune_disk(self):
+        """Borra las entradas vencidas y, si sobran, las más viejas"""
+        try:
+            entries = []
+            for entry in os.scandir(self.disk_dir):
+                if entry.name.endswith('.json'):
+                    entries.append((entry.stat().st_mtime, entry.path))
+        except OSError as e:
+            logger.warning(f"Error recorriendo la caché de análisis en disco: {e}")
+            return
+
+        entries.sort()
+        expired_before = time.time() - self.ttl
+        excess = len(entries) - self.disk_max_entries
+        for index, (mtime, path) in enumerate(entries):
+            if mtime > expired_before and index >= excess:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+# Caché compartida de análisis de gráficos (functions.analyze_image y chat.analyze_chart_image)
+analysis_cache = AnalysisCache(
+    max_entries=IMAGE_ANALYSIS_CONFIG["cache_max_entries"],
+    ttl=IMAGE_ANALYSIS_CONFIG["cache_ttl_seconds"],
+    disk_dir=IMAGE_ANALYSIS_CONFIG["cache_dir"],
+    disk_max_entries=IMAGE_ANALYSIS_CONFIG["cache_disk_max_entries"],
+    enabled=IMAGE_ANALYSIS_CONFIG["cache_enabled"]
+)
@@ -0,0 +1,279 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Iterable, List, Optional
+
+
+class TTLCache:
+    """
+    Caché en memoria acotada (LRU) con expiración por entrada.
+
+    Es segura para uso entre threads y lleva contadores de hits/misses
+    para poder monitorear su efectividad.
+    """
+
+    def __init__(self, max_entries: int = 1024, default_ttl: Optional[float] = None):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Retorna el valor si existe y no expiró"""
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+
+            value, expires_at = entry
+            if expires_at is not None and expires_at <= now:
+                del self._data[key]
+                self.misses += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None,
+            expires_at: Optional[float] = None):
+        """
+        Guarda un valor. `expires_at` (epoch) tiene prioridad sobre `ttl`;
+        si no se indica ninguno se usa `default_ttl`.
+        """
+        if expires_at is None:
+            ttl = ttl if ttl is not None else self.default_ttl
+            expires_at = time.time() + ttl if ttl is not None else None
+
+        with self._lock:
+            self._data[key] = (value, expires_at)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key: Hashable) -> bool:
+        """Elimina una entrada; retorna True si existía"""
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        """Contadores para monitoreo"""
+        total = self.hits + self.misses
+        return {
+            'size': len(self._data),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / total, 4) if total else 0.0
+        }
+
+
+class _Flight:
+    """Carga en curso para una clave (single-flight)"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error: Optional[BaseException] = None
+
+
+class LoadingCache:
+    """
+    Caché con carga integrada pensada para datos de APIs externas:
+
+    - TTL fresco por entrada: dentro del TTL se sirve directo de memoria.
+    - Stale-while-revalidate: vencido el TTL pero dentro de `stale_ttl` se
+      sirve el valor viejo y se refresca en segundo plano.
+    - Single-flight: N misses concurrentes de la misma clave producen una
+      sola llamada al loader; el resto espera su resultado.
+
+    Si el loader lanza una excepción no se cachea nada y la excepción se
+    propaga a todos los que esperaban esa carga.
+    """
+
+    def __init__(self, max_entries: int = 1024):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._inflight: Dict[Hashable, _Flight] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.loads = 0
+        self.load_errors = 0
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any], ttl: float, stale_ttl: float = 0) -> Any:
+        now = time.time()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, fresh_until, stale_until = entry
+                if now < fresh_until:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                if now < stale_until:
+                    self._data.move_to_end(key)
+                    self.stale_hits += 1
+                    refresh = key not in self._inflight
+                    if refresh:
+                        self._inflight[key] = _Flight()
+                else:
+                    entry = None
+            if entry is None:
+                self.misses += 1
+                flight = self._inflight.get(key)
+                leader = flight is None
+                if leader:
+                    flight = self._inflight[key] = _Flight()
+
+        if entry is not None:
+            # Valor viejo: servirlo y refrescar en segundo plano (una sola vez)
+            if refresh:
+                threading.Thread(
+                    target=self._load, args=(key, loader, ttl, stale_ttl), daemon=True
+                ).start()
+            return value
+
+        if leader:
+            self._load(key, loader, ttl, stale_ttl)
+        else:
+            flight.done.wait()
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.value
+
+    def _load(self, key: Hashable, loader: Callable[[], Any], ttl: float, stale_ttl: float):
+        """Ejecuta el loader y publica el resultado a quienes esperan"""
+        flight = self._inflight[key]
+        try:
+            value = loader()
+            self.set(key, value, ttl, stale_ttl)
+            flight.value = value
+            self.loads += 1
+        except BaseException as e:
+            flight.error = e
+            self.load_errors += 1
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    def get_or_load_many(self, keys: Iterable[Hashable], loader: Callable[[List[Hashable]], Dict[Hashable, Any]],
+                         ttl: float, stale_ttl: float = 0) -> Dict[Hashable, Any]:
+        """
+        Variante en lote de get_or_load: `loader(claves)` retorna
+        {clave: valor}. Las claves frescas se sirven de memoria, las que ya
+        se están cargando (en lote o de a una) se esperan y el resto se
+        registra en vuelo y se carga con una sola llamada. Si alguna carga
+        falla se propaga su excepción.
+        """
+        now = time.time()
+        flights: Dict[Hashable, _Flight] = {}
+        leading = []
+        values = {}
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                entry = self._data.get(key)
+                if entry is not None and now < entry[1]:
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    values[key] = entry[0]
+                    continue
+                self.misses += 1
+                flight = self._inflight.get(key)
+                if flight is None:
+                    flight = self._inflight[key] = _Flight()
+                    leading.append(key)
+                flights[key] = flight
+
+        if leading:
+            self._load_many(leading, loader, ttl, stale_ttl)
+
+        for key, flight in flights.items():
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            values[key] = flight.value
+        return values
+
+    def _load_many(self, keys: List[Hashable], loader: Callable[[List[Hashable]], Dict[Hashable, Any]],
+                   ttl: float, stale_ttl: float):
+        """Ejecuta el loader en lote y publica cada resultado a quienes esperan esa clave"""
+        flights = [self._inflight[key] for key in keys]
+        try:
+            loaded = loader(keys)
+            error = None
+            self.loads += 1
+        except BaseException as e:
+            loaded = {}
+            error = e
+            self.load_errors += 1
+
+        for key, flight in zip(keys, flights):
+            if key in loaded:
+                self.set(key, loaded[key], ttl, stale_ttl)
+                flight.value = loaded[key]
+            else:
+                flight.error = error or KeyError(key)
+        with self._lock:
+            for key in keys:
+                self._inflight.pop(key, None)
+        for flight in flights:
+            flight.done.set()
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        """Retorna el valor si está fresco, sin cargar"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and time.time() < entry[1]:
+                return entry[0]
+        return default
+
+    def get_stale(self, key: Hashable, default: Any = None) -> Any:
+        """Retorna el valor si está fresco o dentro de `stale_ttl`, sin cargar"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and time.time() < entry[2]:
+                return entry[0]
+        return default
+
+    def set(self, key: Hashable, value: Any, ttl: float, stale_ttl: float = 0):
+        now = time.time()
+        with self._lock:
+            self._data[key] = (value, now + ttl, now + ttl + stale_ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable) -> bool:
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def stats(self) -> Dict[str, Any]:
+        """Contadores para monitoreo"""
+        return {
+            'size': len(self._data),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'stale_hits': self.stale_hits,
+            'misses': self.misses,
+            'loads': self.loads,
+            'load_errors': self.load_errors,
+            'in_flight': len(self._inflight)
+        }
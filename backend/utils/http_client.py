@@ -0,0 +1,95 @@
+import random
+import threading
+import time
+import logging
+from typing import Any, Dict, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config.assistant_config import EXTERNAL_APIS, RETRY_CONFIG, HTTP_POOL_CONFIG
+
+# Configurar logging
+logger = logging.getLogger(__name__)
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+def get_session() -> requests.Session:
+    """
+    Sesión HTTP compartida por el proceso. Reutiliza conexiones (keep-alive)
+    para no pagar el handshake TCP+TLS en cada llamada.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=HTTP_POOL_CONFIG["pool_connections"],
+                    pool_maxsize=HTTP_POOL_CONFIG["pool_maxsize"]
+                )
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                _session = session
+    return _session
+
+def _backoff_delay(attempt: int) -> float:
+    """Backoff exponencial con jitter completo según RETRY_CONFIG"""
+    delay = RETRY_CONFIG["retry_delay_seconds"] * (RETRY_CONFIG["backoff_multiplier"] ** attempt)
+    return random.uniform(0, delay)
+
+def _retry_after(response: requests.Response) -> Optional[float]:
+    """Segundos indicados por el header Retry-After (si es numérico)"""
+    value = response.headers.get("Retry-After")
+    if value and value.isdigit():
+        return min(float(value), HTTP_POOL_CONFIG["max_retry_after_seconds"])
+    return None
+
+def _can_retry(attempt: int, delay: float, deadline: float) -> bool:
+    """Indica si queda otro reintento y tiempo para esperar `delay` y hacer un intento útil"""
+    if attempt >= RETRY_CONFIG["max_retries"]:
+        return False
+    return deadline - time.monotonic() - delay >= RETRY_CONFIG["min_attempt_seconds"]
+
+def get_json(api_name: str, path: str, params: Optional[Dict[str, Any]] = None,
+             deadline_seconds: Optional[float] = None) -> Any:
+    """
+    GET a una API de EXTERNAL_APIS usando su base_url y timeout.
+    Reintenta errores de conexión, timeouts y códigos transitorios
+    (429/5xx) con backoff exponencial y jitter, sin pasarse de
+    `deadline_seconds` en total (por defecto `total_deadline_seconds`).
+    Si se agotan los reintentos o el plazo lanza la excepción de
+    requests correspondiente.
+    """
+    api_config = EXTERNAL_APIS[api_name]
+    url = f"{api_config['base_url']}{path}"
+    deadline = time.monotonic() + (deadline_seconds or RETRY_CONFIG["total_deadline_seconds"])
+    session = get_session()
+
+    attempt = 0
+    while True:
+        # Cada intento se acota a lo que queda del plazo
+        timeout = min(api_config["timeout"], max(deadline - time.monotonic(), RETRY_CONFIG["min_attempt_seconds"]))
+        try:
+            response = session.get(url, params=params, timeout=timeout)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+            delay = _backoff_delay(attempt)
+            if not _can_retry(attempt, delay, deadline):
+                raise
+            logger.warning(f"Error de conexión con {api_name} ({e}), reintento {attempt + 1} en {delay:.2f}s")
+            time.sleep(delay)
+            attempt += 1
+            continue
+
+        if response.status_code in HTTP_POOL_CONFIG["retry_status_codes"]:
+            delay = _retry_after(response) or _backoff_delay(attempt)
+            if _can_retry(attempt, delay, deadline):
+                logger.warning(f"{api_name} respondió {response.status_code}, reintento {attempt + 1} en {delay:.2f}s")
+                response.close()
+                time.sleep(delay)
+                attempt += 1
+                continue
+
+        response.raise_for_status()
+        return response.json()
@@ -0,0 +1,300 @@
+import base64
+import io
+import ipaddress
+import logging
+import math
+import socket
+import threading
+from typing import Any, BinaryIO, Dict, Optional, Tuple
+from urllib.parse import urljoin, urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config.assistant_config import IMAGE_PREPROCESS_CONFIG, FILE_CONFIG
+
+try:
+    from PIL import Image, ImageChops
+except ImportError:  # Pillow es opcional: sin él las imágenes se envían tal cual
+    Image = None
+    ImageChops = None
+
+# Configurar logging
+logger = logging.getLogger(__name__)
+
+_MIME_TYPES = {"JPEG": "image/jpeg", "WEBP": "image/webp", "PNG": "image/png"}
+
+_stats = {"images": 0, "bytes_saved": 0, "tokens_saved": 0}
+_stats_lock = threading.Lock()
+
+
+def estimate_vision_tokens(width: int, height: int, detail: str = "high") -> int:
+    """
+    Estimación de tokens de visión de OpenAI: 85 fijos en `low`; en
+    `high` la imagen se escala a 2048x2048 y luego a 768 de lado menor,
+    y cada tile de 512x512 cuesta 170.
+    """
+    if detail == "low":
+        return 85
+
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
+
+
+def preprocess_image(content: bytes) -> Tuple[bytes, str, Dict[str, Any]]:
+    """
+    Prepara una imagen para un modelo de visión: recorta bordes de color
+    uniforme, reduce al lado máximo configurado y recodifica en un formato
+    compacto. Retorna (contenido, mime, estadísticas); si no hay Pillow o
+    la imagen no se puede procesar, retorna el contenido original.
+    """
+    config = IMAGE_PREPROCESS_CONFIG
+    if Image is None or not config["enabled"]:
+        return content, "", {}
+
+    try:
+        image = Image.open(io.BytesIO(content))
+        source_format = image.format
+        if getattr(image, "is_animated", False):
+            return content, "", {}
+
+        original_size = image.size
+        image = _flatten(image)
+
+        if config["crop_borders"]:
+            image = _crop_uniform_borders(image, config["border_tolerance"])
+
+        max_edge = config["max_edge_px"]
+        if max(image.size) > max_edge:
+            image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+        output_format = config["format"].upper()
+        output = io.BytesIO()
+        image.save(output, format=output_format, quality=config["quality"], optimize=True)
+        processed = output.getvalue()
+    except Exception as e:
+        logger.warning(f"No se pudo preprocesar la imagen: {e}")
+        return content, "", {}
+
+    detail = "low" if max(image.size) <= config["low_detail_max_px"] else "high"
+    tokens_before = estimate_vision_tokens(*original_size)
+    tokens_after = estimate_vision_tokens(*image.size, detail=detail)
+
+    if len(processed) >= len(content) and image.size == original_size:
+        # No hubo nada que ganar: conservar el original
+        processed = content
+        mime = _MIME_TYPES.get(source_format, "")
+    else:
+        mime = _MIME_TYPES[output_format]
+
+    stats = {
+        "original_size": list(original_size),
+        "size": list(image.size),
+        "detail": detail,
+        "bytes_before": len(content),
+        "bytes_after": len(processed),
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after
+    }
+    _record(stats)
+    return processed, mime, stats
+
+
+def prepare_vision_image(image_url: str, content: Optional[bytes] = None) -> Tuple[str, str]:
+    """
+    Preprocesa la imagen de `image_url` antes de una llamada de visión.
+    Retorna (url, detail): un data URL con la imagen reducida y el nivel
+    de detalle sugerido, o la URL original con "auto" si no se pudo.
+    `content` evita volver a descargar una imagen ya leída.
+    """
+    if content is None:
+        content = load_image_bytes(image_url)
+    if content is None:
+        return image_url, "auto"
+
+    processed, mime, stats = preprocess_image(content)
+    if not stats:
+        return image_url, "auto"
+    if processed is content:
+        return image_url, stats["detail"]
+
+    logger.info(
+        f"Imagen preprocesada {stats['original_size']} -> {stats['size']}: "
+        f"{stats['bytes_before'] - stats['bytes_after']} bytes y "
+        f"~{stats['tokens_before'] - stats['tokens_after']} tokens menos"
+    )
+    return f"data:{mime};base64,{base64.b64encode(processed).decode()}", stats["detail"]
+
+
+def prepare_upload(file: BinaryIO, filename: str) -> Tuple[BinaryIO, str]:
+    """Versión para subidas: retorna (archivo, nombre) listos para enviar"""
+    file.seek(0)
+    content = file.read()
+    file.seek(0)
+
+    processed, mime, stats = preprocess_image(content)
+    if not stats or processed is content:
+        return file, filename
+
+    extension = {"image/jpeg": "jpg", "image/webp": "webp", "image/png": "png"}[mime]
+    return io.BytesIO(processed), f"{filename.rsplit('.', 1)[0]}.{extension}"
+
+
+def dhash(content: bytes, size: int = 16) -> Optional[int]:
+    """
+    Hash perceptual (dHash) de size*size bits: compara cada píxel con su
+    vecino derecho en una versión en grises de (size+1) x size. Se calcula
+    sin los bordes uniformes para tolerar recortes distintos.
+    """
+    if Image is None:
+        return None
+    try:
+        image = _flatten(Image.open(io.BytesIO(content)))
+        image = _crop_uniform_borders(image, IMAGE_PREPROCESS_CONFIG["border_tolerance"])
+        pixels = list(image.convert("L").resize((size + 1, size), Image.LANCZOS).getdata())
+    except Exception as e:
+        logger.warning(f"No se pudo calcular el hash de la imagen: {e}")
+        return None
+
+    value = 0
+    for row in range(size):
+        for col in range(size):
+            left = pixels[row * (size + 1) + col]
+            right = pixels[row * (size + 1) + col + 1]
+            value = (value << 1) | (left > right)
+    return value
+
+
+def load_image_bytes(image_url: str) -> Optional[bytes]:
+    """Contenido de un data URL o de una URL remota (si está habilitado)"""
+    if image_url.startswith("data:"):
+        try:
+            return base64.b64decode(image_url.split(",", 1)[1])
+        except (IndexError, ValueError):
+            return None
+
+    if not IMAGE_PREPROCESS_CONFIG["fetch_remote"]:
+        return None
+
+    max_bytes = FILE_CONFIG["max_file_size_mb"] * 1024 * 1024
+    try:
+        # Las redirecciones se siguen a mano para validar cada destino
+        for _ in range(IMAGE_PREPROCESS_CONFIG["fetch_max_redirects"] + 1):
+            address = resolve_public_address(image_url)
+            if address is None:
+                logger.warning(f"URL de imagen rechazada (host no público): {image_url}")
+                return None
+            with _pinned_session(image_url) as session, session.get(
+                _pinned_url(image_url, address),
+                headers={"Host": urlsplit(image_url).netloc.rsplit("@", 1)[-1]},
+                timeout=IMAGE_PREPROCESS_CONFIG["fetch_timeout"],
+                stream=True,
+                allow_redirects=False
+            ) as response:
+                if response.is_redirect:
+                    image_url = urljoin(image_url, response.headers["Location"])
+                    continue
+                response.raise_for_status()
+                content = bytearray()
+                for chunk in response.iter_content(64 * 1024):
+                    content.extend(chunk)
+                    if len(content) > max_bytes:
+                        return None
+                return bytes(content)
+        return None
+    except Exception as e:
+        logger.warning(f"No se pudo descargar la imagen para preprocesarla: {e}")
+        return None
+
+
+def resolve_public_address(url: str) -> Optional[str]:
+    """
+    Resuelve el host de una URL http(s) y retorna una de sus direcciones
+    si todas son públicas (ni privadas, ni loopback, ni link-local, ni
+    reservadas); None en otro caso. La descarga se conecta a esa misma
+    dirección, así un DNS que cambia de respuesta no puede saltear el chequeo.
+    """
+    try:
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            return None
+        addresses = socket.getaddrinfo(parts.hostname, parts.port or 443, proto=socket.IPPROTO_TCP)
+    except (ValueError, OSError):
+        return None
+
+    for address in addresses:
+        ip = ipaddress.ip_address(address[4][0].split("%", 1)[0])
+        if getattr(ip, "ipv4_mapped", None):
+            ip = ip.ipv4_mapped
+        if not ip.is_global or ip.is_multicast:
+            return None
+    return addresses[0][4][0] if addresses else None
+
+
+class _PinnedHostAdapter(HTTPAdapter):
+    """Adapter que conecta a una IP ya validada conservando el hostname para SNI y el certificado"""
+
+    def __init__(self, hostname: str):
+        self.hostname = hostname
+        super().__init__()
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["server_hostname"] = self.hostname
+        kwargs["assert_hostname"] = self.hostname
+        super().init_poolmanager(*args, **kwargs)
+
+
+def _pinned_session(url: str) -> requests.Session:
+    """Sesión de un solo uso para descargar `url` desde la IP validada"""
+    parts = urlsplit(url)
+    session = requests.Session()
+    session.trust_env = False  # Sin proxies del entorno: se conecta directo a la IP
+    session.mount(f"{parts.scheme}://", _PinnedHostAdapter(parts.hostname))
+    return session
+
+
+def _pinned_url(url: str, address: str) -> str:
+    """La misma URL con el host reemplazado por la IP"""
+    parts = urlsplit(url)
+    host = f"[{address}]" if ":" in address else address
+    if parts.port:
+        host = f"{host}:{parts.port}"
+    return urlunsplit((parts.scheme, host, parts.path, parts.query, ""))
+
+
+def get_preprocess_stats() -> Dict[str, Any]:
+    """Acumulados del preprocesamiento (para monitoreo)"""
+    with _stats_lock:
+        return {"pillow_available": Image is not None, **_stats}
+
+
+def _flatten(image):
+    """Convierte a RGB, apoyando la transparencia sobre fondo blanco"""
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.split()[-1])
+        return background
+    return image.convert("RGB")
+
+
+def _crop_uniform_borders(image, tolerance: int):
+    """Recorta los bordes del mismo color que la esquina superior izquierda"""
+    background = Image.new(image.mode, image.size, image.getpixel((0, 0)))
+    diff = ImageChops.difference(image, background)
+    diff = ImageChops.add(diff, diff, 2.0, -tolerance)
+    bbox = diff.getbbox()
+    if bbox and bbox != (0, 0) + image.size:
+        return image.crop(bbox)
+    return image
+
+
+def _record(stats: Dict[str, Any]):
+    with _stats_lock:
+        _stats["images"] += 1
+        _stats["bytes_saved"] += stats["bytes_before"] - stats["bytes_after"]
+        _stats["tokens_saved"] += stats["tokens_before"] - stats["tokens_after"]
@@ -0,0 +1,31 @@
+import base64
+import json
+from typing import Any, Dict, Optional
+
+def encode_cursor(data: Dict[str, Any]) -> str:
+    """Codifica un cursor opaco para el cliente"""
+    raw = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor: Optional[str]) -> Optional[Dict[str, Any]]:
+    """
+    Decodifica un cursor generado por encode_cursor.
+    Retorna None si no hay cursor; lanza ValueError si es inválido.
+    """
+    if not cursor:
+        return None
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except Exception:
+        raise ValueError('Cursor inválido')
+    if not isinstance(data, dict):
+        raise ValueError('Cursor inválido')
+    return data
+
+def get_page_size(args, default: int, maximum: int) -> int:
+    """Lee `page_size` de los query params, acotado entre 1 y `maximum`"""
+    page_size = args.get('page_size', default, type=int)
+    if page_size is None:
+        page_size = default
+    return max(1, min(page_size, maximum))
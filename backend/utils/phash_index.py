@@ -0,0 +1,86 @@
+import threading
+import time
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:  # NumPy es opcional: sin él el índice queda deshabilitado
+    np = None
+
+# Cantidad de bits en 1 para cada byte posible
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8) if np is not None else None
+
+
+class PerceptualIndex:
+    """
+    Índice de hashes perceptuales de `hash_bits` bits para encontrar
+    imágenes casi iguales (mismo gráfico con otro recorte o unos segundos
+    después).
+
+    Los hashes se guardan como una matriz N x (hash_bits / 8) de bytes y la búsqueda
+    calcula la distancia de Hamming contra todas las filas de una vez
+    (XOR + tabla de popcount). Es un buffer circular: al llenarse se pisa
+    la entrada más vieja. Cada entrada pertenece a un `namespace` (por
+    ejemplo, tipo de análisis + versión de prompt) y vence tras `ttl`.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, hash_bits: int = 256, enabled: bool = True):
+        self.enabled = enabled and np is not None
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hash_bits = hash_bits
+        self._row_bytes = hash_bits // 8
+        self._lock = threading.Lock()
+        self._next = 0
+        self._namespaces: Dict[Hashable, int] = {}
+        self._values = [None] * max_entries
+        self.hits = 0
+        self.misses = 0
+
+        if self.enabled:
+            self._bits = np.zeros((max_entries, self._row_bytes), dtype=np.uint8)
+            self._namespace_ids = np.full(max_entries, -1, dtype=np.int32)
+            self._expires_at = np.zeros(max_entries, dtype=np.float64)
+
+    def add(self, phash: int, namespace: Hashable, value: Any):
+        if not self.enabled:
+            return
+        with self._lock:
+            slot = self._next
+            self._next = (self._next + 1) % self.max_entries
+            self._bits[slot] = self._to_row(phash)
+            self._namespace_ids[slot] = self._namespaces.setdefault(namespace, len(self._namespaces))
+            self._expires_at[slot] = time.time() + self.ttl
+            self._values[slot] = value
+
+    def find(self, phash: int, namespace: Hashable, max_distance: int) -> Optional[Tuple[Any, int]]:
+        """Retorna (valor, distancia) de la entrada más parecida dentro del umbral"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            namespace_id = self._namespaces.get(namespace)
+            if namespace_id is not None:
+                distances = _POPCOUNT[np.bitwise_xor(self._bits, self._to_row(phash))].sum(axis=1, dtype=np.int32)
+                valid = (self._namespace_ids == namespace_id) & (self._expires_at > time.time())
+                distances = np.where(valid, distances, self.hash_bits + 1)
+                slot = int(distances.argmin())
+                if distances[slot] <= max_distance:
+                    self.hits += 1
+                    return self._values[slot], int(distances[slot])
+            self.misses += 1
+            return None
+
+    def stats(self) -> Dict[str, Any]:
+        """Contadores para monitoreo"""
+        size = int((self._expires_at > time.time()).sum()) if self.enabled else 0
+        return {
+            'enabled': self.enabled,
+            'size': size,
+            'max_entries': self.max_entries,
+            'hash_bits': self.hash_bits,
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+    def _to_row(self, phash: int):
+        return np.frombuffer(phash.to_bytes(self._row_bytes, 'big'), dtype=np.uint8)
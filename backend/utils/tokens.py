@@ -0,0 +1,65 @@
+from functools import lru_cache
+from typing import Any, Dict, List
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken es opcional: sin él se estima ~4 caracteres por token
+    tiktoken = None
+
+# Tokens extra que agrega cada mensaje del chat (rol y separadores)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Tokens que agrega el cebado de la respuesta
+REPLY_PRIMING_TOKENS = 3
+
+
+@lru_cache(maxsize=16)
+def _get_encoding(model: str):
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception:
+        # Sin acceso a los archivos de la codificación: usar la estimación
+        return None
+
+
+def count_tokens(text: str, model: str) -> int:
+    """Tokens de un texto para el modelo (estimados si no hay tiktoken)"""
+    if not text:
+        return 0
+    encoding = _get_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def count_message_tokens(messages: List[Dict[str, Any]], model: str) -> int:
+    """Tokens de una lista de mensajes de chat, incluida la sobrecarga por mensaje"""
+    return sum(
+        count_tokens(message_text(message), model) + MESSAGE_OVERHEAD_TOKENS
+        for message in messages
+    ) + REPLY_PRIMING_TOKENS
+
+
+def message_text(message: Dict[str, Any]) -> str:
+    """Texto de un mensaje, sea contenido simple o lista de partes"""
+    content = message.get("content") or ""
+    if isinstance(content, str):
+        return content
+    return "\n".join(part.get("text", "") for part in content if isinstance(part, dict))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str) -> str:
+    """Recorta el texto a sus primeros `max_tokens` tokens"""
+    encoding = _get_encoding(model)
+    if encoding is None:
+        limit = max_tokens * 4
+        return text if len(text) <= limit else text[:limit] + "…"
+
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens]) + "…"
@@ -0,0 +1,90 @@
+import hashlib
+from tempfile import SpooledTemporaryFile
+from typing import Any, BinaryIO, Optional
+
+from flask import Request
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from config.assistant_config import FILE_CONFIG
+
+MAX_UPLOAD_BYTES = FILE_CONFIG["max_file_size_mb"] * 1024 * 1024
+SPOOL_MAX_BYTES = FILE_CONFIG["spool_max_memory_mb"] * 1024 * 1024
+
+
+class UploadBuffer:
+    """
+    Buffer donde Werkzeug vuelca cada archivo del multipart.
+
+    Se mantiene en memoria hasta `spool_bytes` (solo pasa a disco por
+    encima de eso) y corta la subida apenas se supera `max_bytes`, sin
+    esperar a tener el archivo completo. De paso calcula el sha256 del
+    contenido para poder deduplicar.
+    """
+
+    def __init__(self, max_bytes: int = MAX_UPLOAD_BYTES, spool_bytes: int = SPOOL_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._sha256 = hashlib.sha256()
+        self._file = SpooledTemporaryFile(max_size=spool_bytes, mode="w+b")
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise RequestEntityTooLarge()
+        self._sha256.update(data)
+        return self._file.write(data)
+
+    @property
+    def digest(self) -> str:
+        return self._sha256.hexdigest()
+
+    def __getattr__(self, name: str) -> Any:
+        # read/seek/tell/close/... van directo al spool. `fileno` no: pedirlo
+        # pasa el spool a disco, y httpx lo usa solo para medir el tamaño
+        # (sin él lo mide con seek/tell)
+        if name == "fileno":
+            raise AttributeError(name)
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+
+class UploadRequest(Request):
+    """Request de Flask que recibe los archivos en un UploadBuffer"""
+
+    def _get_file_stream(self, total_content_length: Optional[int], content_type: Optional[str],
+                         filename: Optional[str] = None, content_length: Optional[int] = None) -> BinaryIO:
+        return UploadBuffer()
+
+
+def upload_size(file) -> int:
+    """
+    Tamaño del archivo recibido. Con UploadRequest ya se midió mientras
+    llegaba; si no, se mide con seek.
+    """
+    stream = file.stream
+    if isinstance(stream, UploadBuffer):
+        return stream.size
+
+    stream.seek(0, 2)
+    size = stream.tell()
+    stream.seek(0)
+    return size
+
+
+def upload_digest(file) -> str:
+    """
+    sha256 (hex) del archivo recibido. Con UploadRequest ya se calculó
+    mientras llegaba; si no, se lee el stream por bloques.
+    """
+    stream = file.stream
+    if isinstance(stream, UploadBuffer):
+        return stream.digest
+
+    sha256 = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(64 * 1024), b''):
+        sha256.update(chunk)
+    stream.seek(0)
+    return sha256.hexdigest()